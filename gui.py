@@ -39,12 +39,9 @@ class GUI(basicgui.Ui_GUI, QtCore.QObject):
         self.mainwindow.show()
 
     def getFires(self):
-        burnFolder = 'data/'
-        burns = os.listdir(burnFolder)
+        burns = rawdata.availableBurns()
         model = QtGui.QStandardItemModel()
         for name in burns:
-            if name.startswith('.'):
-                continue
             item = QtGui.QStandardItem(name)
             item.setCheckable(True)
             item.setFlags(QtCore.Qt.ItemIsUserCheckable | QtCore.Qt.ItemIsEnabled)
@@ -0,0 +1,309 @@
+# augmentation.py
+'''Make rotated copies of burns, so there is more data to train on.
+
+What to augment is described by a JSON config:
+
+    {"variants": 50,
+     "seed": 0,
+     "rotationRange": 40,
+     "output": "data/",
+     "fires": {"riceRidge": [["0731", "0801", "0802", "0803"]],
+               "junkins": [["1028", "1029", "1030"], ["1020", "1021"]]}}
+
+Every fire has a list of groups of days. For every group, `variants` rotated
+copies are written, each as a new burn folder in `output` with its own
+layers, perimeters and weather (with the wind direction rotated to match).
+
+The layers of a fire are cached by layerstore once, before any work starts,
+and then the variants are made in parallel by a pool of processes. Each
+variant gets its own seed, derived from the config's seed and which fire,
+group and variant it is, so the output is the same no matter how many
+processes are used or in what order they finish. Everything that was made
+is recorded in a manifest, `<output>_augmented.json`.
+
+Training only ever samples pixels near the fire front (see
+Dataset.vulnerablePixels) and the AOIs around them. With "roi": true in the
+config, only that region is augmented: the box around the union of the
+vulnerable rings of a group's days, grown by the AOI halo. The variant is
+cut out as the square that circumscribes that box, so that after turning
+it by any angle the whole region is still inside it. Only that square is read
+from the layers, rotated and written, and the manifest records where in
+the original burn it came from. "vulnerableRadius" (meters) and "AOIRadius"
+(pixels) say how big the region is.
+
+A crop (or the corners cut off by rotating) has a different min and range
+than the whole fire, so it would be normalized differently. So each variant
+also gets a source.json, with its manifest entry and the statistics of the
+layers of the whole fire it came from, and Burns loaded from a variant
+are normalized with those (see rawdata.Burn.source).'''
+import os
+import json
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from lib import image
+from lib import util
+from lib import layerstore
+from lib import normalization
+from lib import weather
+from lib import selection
+from lib import dataset
+
+# the layers of a burn that get rotated along with its perimeters
+LAYERS = ['dem', 'aspect', 'slope', 'band_4', 'band_3', 'band_2', 'band_5', 'ndvi']
+
+DEFAULTS = {'variants': 1,
+            'seed': 0,
+            'rotationRange': 40,
+            'output': 'data/',
+            'roi': False,
+            'vulnerableRadius': dataset.Dataset.VULNERABLE_RADIUS,
+            'AOIRadius': 30}
+
+# what every variant's folder says about where it came from, see makeVariant()
+SOURCE_FILE = 'source.json'
+
+# the most recently stacked fire in this process, see stackFire()
+_memoed = {}
+
+def loadConfig(fname):
+    '''Read and check a config, filling in the defaults'''
+    with open(fname, 'r') as fp:
+        config = json.load(fp)
+    return checkConfig(config)
+
+def checkConfig(config):
+    config = dict(DEFAULTS, **config)
+    if not config.get('fires'):
+        raise ValueError("An augmentation config needs at least one fire")
+    if config['variants'] < 1:
+        raise ValueError("variants must be at least 1, got {}".format(config['variants']))
+    for fire, groups in config['fires'].items():
+        for days in groups:
+            if not days:
+                raise ValueError("The fire {} has an empty group of days".format(fire))
+    if not config['output'].endswith('/'):
+        config['output'] += '/'
+    return config
+
+def jobs(config):
+    '''Every variant to make, as (fire, group, days, variant, seed), in a fixed order'''
+    result = []
+    for fire in sorted(config['fires']):
+        for group, days in enumerate(config['fires'][fire]):
+            for variant in range(config['variants']):
+                seed = variantSeed(config['seed'], fire, group, variant)
+                result.append((fire, group, tuple(days), variant, seed))
+    return result
+
+def variantSeed(seed, fire, group, variant):
+    '''A seed that only depends on its arguments (unlike hash(), which changes between runs)'''
+    key = '{}/{}/{}/{}'.format(seed, fire, group, variant)
+    return zlib.crc32(key.encode())
+
+def variantName(fire, group, variant):
+    return '{}Augmented{}_{:03d}'.format(fire, group, variant)
+
+def run(config, workers=None):
+    '''Make every variant in a config, using `workers` processes (None uses
+    every core). Returns the manifest, which is also saved next to the variants.'''
+    config = checkConfig(config)
+    todo = jobs(config)
+    # fill the layer and weather caches up front, so the
+    # workers only ever read them and don't race to build them
+    stats = {}
+    for fire in config['fires']:
+        for fname in layerFileNames(fire).values():
+            layerstore.ensureCached(fname)
+        weather.refresh(fire)
+        stats[fire] = sourceStats(fire)
+    # the part of each group that gets augmented, None for everything
+    windows = {}
+    if config['roi']:
+        for fire, groups in config['fires'].items():
+            for group, days in enumerate(groups):
+                roi = regionOfInterest(fire, days, config['vulnerableRadius'], config['AOIRadius'])
+                windows[fire, group] = circumscribe(roi) if roi is not None else None
+
+    if workers is None:
+        workers = os.cpu_count()
+    args = [(job, config, windows.get(job[:2]), stats[job[0]]) for job in todo]
+    if workers > 1:
+        # hand each process a whole group's variants at a time,
+        # so it only has to stack each fire once
+        with ProcessPoolExecutor(workers) as pool:
+            entries = list(pool.map(_makeVariant, args, chunksize=config['variants']))
+    else:
+        entries = list(map(_makeVariant, args))
+
+    result = {'config':config, 'variants':entries}
+    saveManifest(config['output'], result)
+    return result
+
+def _makeVariant(args):
+    job, config, window, stats = args
+    return makeVariant(job, config['rotationRange'], config['output'], window, stats)
+
+def makeVariant(job, rotationRange, output, window=None, stats=None):
+    '''Rotate one fire by a random angle and save it as a new burn.
+    If window is given, only that part of the fire is used, see stackFire().
+    stats are the sourceStats() of the fire, which are saved with the
+    variant so it gets normalized like the whole fire.
+    Returns the manifest entry for it.'''
+    fire, group, days, variant, seed = job
+    stack, names = stackFire(fire, days, window)
+    theta = np.random.RandomState(seed).uniform(-rotationRange, rotationRange)
+    rotated = rotate(stack, theta)
+
+    name = variantName(fire, group, variant)
+    folder = output + name + '/'
+    os.makedirs(folder + 'perims/', exist_ok=True)
+    os.makedirs(folder + 'weather/', exist_ok=True)
+    for i, layerName in enumerate(names):
+        if layerName == 'aspect':
+            # the slopes face a new way now, too
+            util.saveImg(folder + layerName + '.tif', turnAspect(rotated[:,:,i], theta))
+        elif layerName in LAYERS:
+            util.saveImg(folder + layerName + '.tif', rotated[:,:,i])
+        else:
+            # a perimeter. Outside of the original extent nothing is burned
+            perim = rotated[:,:,i]
+            perim[~np.isfinite(perim)] = 0
+            util.saveImg(folder + 'perims/' + layerName + '.tif', perim)
+    for date in days:
+        saveRotatedWeather(fire, date, theta, folder + 'weather/' + date + '.csv')
+
+    entry = {'name':name, 'fire':fire, 'group':group, 'days':list(days),
+             'variant':variant, 'seed':seed, 'theta':float(theta)}
+    if window is not None:
+        # where the variant's (0, 0) pixel was in the original fire
+        entry['window'] = [int(v) for v in window]
+    with open(folder + SOURCE_FILE, 'w') as fp:
+        json.dump(dict(entry, stats=stats if stats is not None else sourceStats(fire)), fp, sort_keys=True, indent=1)
+    return entry
+
+def sourceStats(fire):
+    '''The statistics of every layer of a whole fire, as {layerName: LayerStats.toDict()}'''
+    return {name:normalization.LayerStats().update(layerstore.openLayer(fname)).toDict()
+            for name, fname in layerFileNames(fire).items()}
+
+def stackFire(fire, days, window=None):
+    '''Stack the layers and perimeters of a fire into one (height, width, nchannels)
+    array. Returns (stack, channelNames).
+
+    window is (top, left, height, width) in the fire's pixels, and can hang
+    over its edges. By default it is the whole fire plus a 1 pixel border.
+    The outermost pixels of the stack, and anything outside the fire, are nan.
+    The last stack is memoed, so a process making many variants of the
+    same group only reads it once.'''
+    key = (fire, tuple(days), None if window is None else tuple(window))
+    if key not in _memoed:
+        _memoed.clear()
+        fnames = layerFileNames(fire)
+        names = list(LAYERS) + list(days)
+        for date in days:
+            fnames[date] = perimFileName(fire, date)
+        h, w = layerstore.openLayer(fnames[LAYERS[0]]).shape[:2]
+        if window is None:
+            window = (-1, -1, h+2, w+2)
+        top, left, height, width = window
+        # the part of the window that is inside the fire
+        y0, x0 = max(top, 0), max(left, 0)
+        y1, x1 = min(top+height, h), min(left+width, w)
+        stack = np.full((height, width, len(names)), np.nan, dtype=np.float32)
+        for i, name in enumerate(names):
+            layer = layerstore.openLayer(fnames[name])
+            if layer.shape[:2] != (h, w):
+                raise ValueError("The layer {} of {} is {}, not {}".format(name, fire, layer.shape, (h, w)))
+            if y0 < y1 and x0 < x1:
+                stack[y0-top:y1-top, x0-left:x1-left, i] = layer[y0:y1, x0:x1]
+        # the nan border lets rotate() tell what came from outside the window
+        stack[[0, -1]] = np.nan
+        stack[:, [0, -1]] = np.nan
+        _memoed[key] = (stack, names)
+    return _memoed[key]
+
+def regionOfInterest(fire, days, vulnerableRadius, AOIRadius):
+    '''The (top, left, bottom, right) box, in pixels, around every pixel
+    within vulnerableRadius meters of the perimeter of any of the days, and
+    the AOIs around them. None if there aren't any such pixels.'''
+    union = None
+    for date in days:
+        perim = layerstore.openLayer(perimFileName(fire, date))
+        burning = np.isfinite(perim) & (perim != 0)
+        ring = selection.ringMask(selection.distanceFromPerim(burning), 0, vulnerableRadius)
+        union = ring if union is None else union | ring
+    ys, xs = np.nonzero(union)
+    if len(ys) == 0:
+        return None
+    # an AOI turned by any angle reaches sqrt(2) times as far as a straight one
+    halo = int(np.ceil(AOIRadius * np.sqrt(2)))
+    h, w = union.shape
+    return (max(ys.min()-halo, 0), max(xs.min()-halo, 0),
+            min(ys.max()+halo+1, h), min(xs.max()+halo+1, w))
+
+def circumscribe(box):
+    '''The (top, left, height, width) square around the circle around a
+    (top, left, bottom, right) box, so the box stays inside it when it is
+    turned about the square's center by any angle'''
+    top, left, bottom, right = box
+    # plus a pixel for rounding, and one for the nan border of stackFire()
+    size = int(np.ceil(np.hypot(bottom-top, right-left))) + 4
+    centerY, centerX = (top+bottom)//2, (left+right)//2
+    return (centerY - size//2, centerX - size//2, size, size)
+
+def rotate(stack, theta):
+    '''Rotate a channels-last stack by theta degrees clockwise about its center.
+    Pixels that come from outside the stack take the value of the closest
+    edge pixel, which is nan for stacks from stackFire().'''
+    h, w = stack.shape[:2]
+    rad = np.deg2rad(theta)
+    matrix = np.array([[np.cos(rad), -np.sin(rad), 0],
+                       [np.sin(rad), np.cos(rad), 0],
+                       [0, 0, 1]])
+    matrix = image.transform_matrix_offset_center(matrix, h, w)
+    return image.apply_transform(stack, matrix, channel_axis=2, fill_mode='nearest')
+
+def turnAspect(aspect, theta):
+    '''Turn aspects (the compass direction each pixel faces, in degrees) by
+    theta degrees clockwise, like rotate() turns the landscape. Flat pixels
+    (negative), NoData and the nan outside of the fire are left alone.'''
+    aspect = np.array(aspect)
+    with np.errstate(invalid='ignore'):
+        facing = (aspect >= 0) & (aspect <= 360)
+    aspect[facing] = (aspect[facing] + theta) % 360
+    return aspect
+
+def saveRotatedWeather(fire, date, theta, fname):
+    '''Write a copy of a weather CSV with the wind direction turned by theta degrees,
+    so the wind still blows the same way relative to the rotated landscape'''
+    with open('data/{}/weather/{}.csv'.format(fire, date), 'r') as fp:
+        header = fp.readline().rstrip('\r\n')
+    table = weather.table(fire, date).copy()
+    col = weather.WIND_DIRECTION
+    table[:, col] = (table[:, col] + theta) % 360
+    # enough digits that reading it back gives exactly the same numbers
+    np.savetxt(fname, table, delimiter=',', fmt='%.17g', header=header, comments='')
+
+def perimFileName(fire, date):
+    return 'data/{}/perims/{}.tif'.format(fire, date)
+
+def layerFileNames(fire):
+    return {name:'data/{}/{}.tif'.format(fire, name) for name in LAYERS}
+
+def manifestName(output):
+    return output + '_augmented.json'
+
+def saveManifest(output, manifest):
+    os.makedirs(output, exist_ok=True)
+    fname = manifestName(output)
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump(manifest, fp, sort_keys=True, indent=1)
+    os.replace(tmp, fname)
+
+def loadManifest(output='data/'):
+    with open(manifestName(output), 'r') as fp:
+        return json.load(fp)
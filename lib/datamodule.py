@@ -1,6 +1,8 @@
 import numpy as np
 import cv2
 
+from . import weather
+
 PIXEL_SIZE = 30
 
 class Data(object):
@@ -115,10 +117,8 @@ class Data(object):
         return perim
 
     def openWeatherData(dateString):
-        fname = 'data/raw/weather/' + dateString + '.csv'
-        # the first row is the headers, and only cols 4-11 are actual data
-        data = np.loadtxt(fname, skiprows=1, usecols=range(5,12), delimiter=',').T
-        return data
+        # only cols 5-11 are actual data, see weather.py
+        return weather.weatherMatrix('raw', dateString)
 
     def createWeatherMetrics(weatherData):
         temp, dewpt, temp2, wdir, wspeed, precip, hum = weatherData
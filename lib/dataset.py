@@ -1,5 +1,8 @@
+import os
 import math
 from collections import namedtuple
+from collections.abc import MutableMapping
+from functools import partial
 import random
 import json
 from time import localtime, strftime
@@ -9,12 +12,221 @@ import cv2
 # from rawdata import
 from lib import rawdata
 from lib import viz
+from lib import selection
 from keras.preprocessing.image import ImageDataGenerator
 # from model import InputSettings
 
 # create a class that represents a spatial and temporal location that a sample lives at
 Point = namedtuple('Point', ['burnName', 'date', 'location'])
 
+class PointIndex(object):
+    '''A compact, columnar collection of Points.
+
+    Instead of a tuple per point, every point is four numbers: the id of its
+    burn, the id of its date, and its y and x. The ids index into small tables
+    of burn names and dates. Points from the same day are kept together.
+
+    Iterating or indexing with an int gives back Point tuples for code that
+    still wants them.'''
+
+    def __init__(self, burnNames, dates, burnIds, dateIds, ys, xs):
+        self.burnNames = list(burnNames)
+        self.dates = list(dates)
+        self.burnIds = np.asarray(burnIds, dtype=np.int32)
+        self.dateIds = np.asarray(dateIds, dtype=np.int32)
+        self.ys = np.asarray(ys, dtype=np.int32)
+        self.xs = np.asarray(xs, dtype=np.int32)
+        assert len(self.burnIds) == len(self.dateIds) == len(self.ys) == len(self.xs)
+
+    @staticmethod
+    def fromMasks(points):
+        '''Build an index out of a {burnName:{date:mask}} dictionary.
+        Points are ordered by burn, then date, then location.'''
+        burnNames = sorted(points)
+        dates = sorted({date for dayDict in points.values() for date in dayDict})
+        dateLookup = {date:i for i, date in enumerate(dates)}
+        burnIds, dateIds, ys, xs = [], [], [], []
+        for burnId, burnName in enumerate(burnNames):
+            dayDict = points[burnName]
+            for date in sorted(dayDict):
+                if isinstance(dayDict, DayMasks):
+                    y, x = dayDict.coords(date)
+                else:
+                    y, x = np.nonzero(dayDict[date])
+                burnIds.append(np.full(len(y), burnId, dtype=np.int32))
+                dateIds.append(np.full(len(y), dateLookup[date], dtype=np.int32))
+                ys.append(y)
+                xs.append(x)
+        return PointIndex(burnNames, dates, *[_concat(c) for c in (burnIds, dateIds, ys, xs)])
+
+    @staticmethod
+    def fromPoints(points):
+        '''Build an index out of an iterable of Points, keeping their order'''
+        points = list(points)
+        burnNames = sorted({p.burnName for p in points})
+        dates = sorted({p.date for p in points})
+        burnLookup = {b:i for i, b in enumerate(burnNames)}
+        dateLookup = {d:i for i, d in enumerate(dates)}
+        burnIds = [burnLookup[p.burnName] for p in points]
+        dateIds = [dateLookup[p.date] for p in points]
+        ys = [p.location[0] for p in points]
+        xs = [p.location[1] for p in points]
+        return PointIndex(burnNames, dates, burnIds, dateIds, ys, xs)
+
+    @staticmethod
+    def concatenate(indices):
+        '''Join several PointIndex's into one, keeping their order'''
+        burnNames = sorted({b for idx in indices for b in idx.burnNames})
+        dates = sorted({d for idx in indices for d in idx.dates})
+        burnLookup = {b:i for i, b in enumerate(burnNames)}
+        dateLookup = {d:i for i, d in enumerate(dates)}
+        burnIds, dateIds = [], []
+        for idx in indices:
+            burnMap = np.array([burnLookup[b] for b in idx.burnNames], dtype=np.int32)
+            dateMap = np.array([dateLookup[d] for d in idx.dates], dtype=np.int32)
+            burnIds.append(burnMap[idx.burnIds] if len(burnMap) else idx.burnIds)
+            dateIds.append(dateMap[idx.dateIds] if len(dateMap) else idx.dateIds)
+        ys = [idx.ys for idx in indices]
+        xs = [idx.xs for idx in indices]
+        return PointIndex(burnNames, dates, *[_concat(c) for c in (burnIds, dateIds, ys, xs)])
+
+    def dayKeys(self):
+        '''An int per point that is unique to its (burnName, date)'''
+        return self.burnIds.astype(np.int64) * len(self.dates) + self.dateIds
+
+    def days(self):
+        '''Yield ((burnName, date), indices of the points on that day),
+        sorted by burn and then date'''
+        keys = self.dayKeys()
+        order = np.argsort(keys, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(keys[order])) + 1
+        for indices in np.split(order, bounds):
+            if len(indices) == 0:
+                continue
+            first = indices[0]
+            yield (self.burnNames[self.burnIds[first]], self.dates[self.dateIds[first]]), indices
+
+    def take(self, indices):
+        '''Return a new PointIndex of just the points at indices'''
+        return PointIndex(self.burnNames, self.dates, self.burnIds[indices],
+                self.dateIds[indices], self.ys[indices], self.xs[indices])
+
+    def toMasks(self, shapes):
+        '''Convert back to a {burnName:{date:mask}} dictionary.
+        shapes is a function of (burnName, date) that returns the shape of the mask.'''
+        result = {}
+        for (burnName, date), indices in self.days():
+            mask = np.zeros(shapes(burnName, date), dtype=np.uint8)
+            mask[self.ys[indices], self.xs[indices]] = 1
+            result.setdefault(burnName, {})[date] = mask
+        return result
+
+    def toList(self):
+        return list(self)
+
+    def toDict(self, values):
+        '''For compatibility: {Point: value} for an array of values aligned with this index'''
+        return {pt:val for pt, val in zip(self, values)}
+
+    @staticmethod
+    def fromDict(pointDict):
+        '''For compatibility: turn a {Point: value} dictionary into (PointIndex, values)'''
+        index = PointIndex.fromPoints(pointDict.keys())
+        values = np.array(list(pointDict.values()))
+        return index, values
+
+    def save(self, fname):
+        '''Save just the coordinates, in the smallest ints that hold them, uncompressed'''
+        np.savez(fname,
+                 burnNames=np.array(self.burnNames, dtype=str),
+                 dates=np.array(self.dates, dtype=str),
+                 burnIds=_smallest(self.burnIds),
+                 dateIds=_smallest(self.dateIds),
+                 ys=_smallest(self.ys),
+                 xs=_smallest(self.xs))
+
+    @staticmethod
+    def load(fname):
+        with np.load(fname) as archive:
+            return PointIndex.fromArchive(archive)
+
+    @staticmethod
+    def fromArchive(archive):
+        return PointIndex(archive['burnNames'].tolist(), archive['dates'].tolist(),
+                archive['burnIds'], archive['dateIds'], archive['ys'], archive['xs'])
+
+    def __len__(self):
+        return len(self.ys)
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            return Point(self.burnNames[self.burnIds[i]], self.dates[self.dateIds[i]], (int(self.ys[i]), int(self.xs[i])))
+        return self.take(i)
+
+    def __iter__(self):
+        burnIds, dateIds = self.burnIds.tolist(), self.dateIds.tolist()
+        ys, xs = self.ys.tolist(), self.xs.tolist()
+        for b, d, y, x in zip(burnIds, dateIds, ys, xs):
+            yield Point(self.burnNames[b], self.dates[d], (y, x))
+
+    def __eq__(self, other):
+        if not isinstance(other, PointIndex):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        mine = np.array(self.burnNames, dtype=object)[self.burnIds], np.array(self.dates, dtype=object)[self.dateIds]
+        theirs = np.array(other.burnNames, dtype=object)[other.burnIds], np.array(other.dates, dtype=object)[other.dateIds]
+        return bool(np.all(mine[0] == theirs[0]) and np.all(mine[1] == theirs[1]) and
+                np.array_equal(self.ys, other.ys) and np.array_equal(self.xs, other.xs))
+
+    def __repr__(self):
+        return "PointIndex({} points from {} burns)".format(len(self), len(set(self.burnIds.tolist())))
+
+def _spreadAcrossDays(counts, n, rng):
+    '''Choose n of the sum(counts) points uniformly at random without replacement,
+    where counts[i] points are on day i, and return how many got chosen from each day'''
+    counts = np.asarray(counts, dtype=np.int64)
+    total = counts.sum()
+    if n >= total:
+        return counts
+    chosen = rng.choice(total, n, replace=False)
+    whichDay = np.searchsorted(np.cumsum(counts), chosen, side='right')
+    return np.bincount(whichDay, minlength=len(counts))
+
+def _smallest(arr):
+    '''arr as the smallest unsigned int type that can hold it'''
+    biggest = int(arr.max()) if len(arr) else 0
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if biggest <= np.iinfo(dtype).max:
+            return arr.astype(dtype)
+    return arr
+
+def _outsideGuard(index, parts, partOfGroup, groups, nby, nbx, blockSize, guard, nparts):
+    '''Which points of a block split (see Dataset.split) have no block of
+    another part within guard pixels of them, in y and in x'''
+    # how many of the blocks of each burn went to each part, as summed area
+    # tables, so counting the blocks in any rectangle of them takes 4 lookups
+    nburns = len(index.burnNames)
+    owned = np.zeros((nparts, nburns * nby * nbx), dtype=np.int32)
+    owned[partOfGroup, groups] = 1
+    owned = owned.reshape(nparts, nburns, nby, nbx)
+    table = np.zeros((nparts, nburns, nby+1, nbx+1), dtype=np.int32)
+    table[:, :, 1:, 1:] = owned.cumsum(axis=2).cumsum(axis=3)
+    # the blocks that the guard band around each point touches
+    y0 = np.clip((index.ys - guard) // blockSize, 0, nby-1)
+    y1 = np.clip((index.ys + guard) // blockSize, 0, nby-1) + 1
+    x0 = np.clip((index.xs - guard) // blockSize, 0, nbx-1)
+    x1 = np.clip((index.xs + guard) // blockSize, 0, nbx-1) + 1
+    b = index.burnIds
+    def blocksIn(t, *part):
+        return t[part+(b, y1, x1)] - t[part+(b, y0, x1)] - t[part+(b, y1, x0)] + t[part+(b, y0, x0)]
+    return blocksIn(table.sum(axis=0)) == blocksIn(table, parts)
+
+def _concat(arrays):
+    if not arrays:
+        return np.zeros(0, dtype=np.int32)
+    return np.concatenate(arrays)
+
 # def load(fname=None):
 #     if fname is None:
 #         # give us the default dataset of everything
@@ -33,17 +245,44 @@ Point = namedtuple('Point', ['burnName', 'date', 'location'])
 #         # print(pts)
 #         return Dataset(data, newBurnDict)
 
-def load(fname=None):
+# the arrays in a file saved by PointIndex.save()
+INDEX_KEYS = {'burnNames', 'dates', 'burnIds', 'dateIds', 'ys', 'xs'}
+
+def load(fname=None, lazy=True):
+    '''Open a saved Dataset. Only the burns and days it uses are loaded,
+    and if lazy, their weather and perimeters are only read when used.'''
     if fname is None:
         # give us the default dataset of everything
         return Dataset(rawdata.load())
+    directory = fixDirName(fname)
+    if os.path.isdir(directory):
+        # saved with Dataset.save()
+        return Dataset(data=None, points=openSparse(directory), lazy=lazy)
     fname = fixFileName(fname)
-    with np.load(fname) as archive:
+    # the old format is pickled dictionaries
+    with np.load(fname, allow_pickle=True) as archive:
+        if INDEX_KEYS.issubset(archive.files):
+            # saved with Dataset.saveIndex()
+            return Dataset(data=None, points=PointIndex.fromArchive(archive), lazy=lazy)
+        # the old format of full masks.
         # np.load gives us back a weird structure.
         # we need structure of {burnName:{date:nparray}}
         d = dict(archive)
         pointList = {burnName:d[burnName][()] for burnName in d}
-        return Dataset(data=None, points=pointList)
+        return Dataset(data=None, points=pointList, lazy=lazy)
+
+def referencedDays(points):
+    '''Return the {burnName: [dates] or 'all'} that some points refer to,
+    or None if that can't be known without looking at every burn'''
+    if isinstance(points, PointIndex):
+        result = {}
+        for burnName, date in (day for day, indices in points.days()):
+            result.setdefault(burnName, []).append(date)
+        return result
+    if isinstance(points, dict):
+        return {burnName:('all' if isinstance(dateDict, str) else sorted(dateDict)) for burnName, dateDict in points.items()}
+    # 'all' or a filter function
+    return None
 
 def fixFileName(fname):
     if not fname.startswith("output/datasets/"):
@@ -52,14 +291,260 @@ def fixFileName(fname):
         fname = fname + '.npz'
     return fname
 
+def fixDirName(fname):
+    if not fname.startswith("output/datasets/"):
+        fname = "output/datasets/" + fname
+    if not fname.endswith('/'):
+        fname = fname + '/'
+    return fname
+
+# The sparse dataset format is a directory with
+#   days.json: {'version', 'compressed', 'days':[{'burn', 'date', 'shape', 'start', 'count'}]}
+#   ys.npy, xs.npy: the coordinates of every point, the points of each day
+#       being the slice [start:start+count]. Or coords.npz if compressed.
+SPARSE_VERSION = 1
+
+def saveSparse(points, directory, compress=False):
+    '''Save a {burnName:{date:mask}} dictionary as just the coordinates of the points'''
+    os.makedirs(directory, exist_ok=True)
+    days, ys, xs = [], [], []
+    start = 0
+    for burnName in sorted(points):
+        dayDict = points[burnName]
+        for date in sorted(dayDict):
+            if isinstance(dayDict, DayMasks):
+                y, x = dayDict.coords(date)
+                shape = dayDict.shape(date)
+            else:
+                mask = dayDict[date]
+                y, x = np.nonzero(mask)
+                shape = mask.shape
+            days.append({'burn':burnName, 'date':date, 'shape':list(shape), 'start':start, 'count':len(y)})
+            ys.append(y)
+            xs.append(x)
+            start += len(y)
+    ys, xs = _smallest(_concat(ys)), _smallest(_concat(xs))
+    if compress:
+        np.savez_compressed(directory+'coords.npz', ys=ys, xs=xs)
+    else:
+        np.save(directory+'ys.npy', ys)
+        np.save(directory+'xs.npy', xs)
+    # written last, so a half-written dataset doesn't look complete
+    with open(directory+'days.json', 'w') as fp:
+        json.dump({'version':SPARSE_VERSION, 'compressed':compress, 'days':days}, fp, indent=1)
+
+def openSparse(directory):
+    '''Open a dataset saved by saveSparse() as {burnName: DayMasks}.
+    Uncompressed coordinates are memory-mapped, and no masks are made until they are used.'''
+    with open(directory+'days.json', 'r') as fp:
+        info = json.load(fp)
+    if info.get('version') != SPARSE_VERSION:
+        raise ValueError("Unknown dataset version {} in {}".format(info.get('version'), directory))
+    if info['compressed']:
+        with np.load(directory+'coords.npz') as archive:
+            ys, xs = archive['ys'], archive['xs']
+    else:
+        ys = np.load(directory+'ys.npy', mmap_mode='r')
+        xs = np.load(directory+'xs.npy', mmap_mode='r')
+    pending = {}
+    for day in info['days']:
+        start, stop = day['start'], day['start']+day['count']
+        builder = CoordinateMask(tuple(day['shape']), ys[start:stop], xs[start:stop])
+        pending.setdefault(day['burn'], {})[day['date']] = builder
+    return {burnName:DayMasks(pending=dayPending) for burnName, dayPending in pending.items()}
+
+class CoordinateMask(object):
+    '''Builds a mask out of the coordinates of its points'''
+
+    def __init__(self, shape, ys, xs):
+        self.shape = shape
+        self.ys = ys
+        self.xs = xs
+
+    def coords(self):
+        return np.asarray(self.ys), np.asarray(self.xs)
+
+    def __call__(self):
+        mask = np.zeros(self.shape, dtype=np.uint8)
+        mask[self.coords()] = 1
+        return mask
+
+class FilteredMask(object):
+    '''Builds a mask out of another mask (or something that builds one)
+    and a filter function of (burn, day), keeping the points in both'''
+
+    def __init__(self, source, filterFunc, burn, day):
+        self.source = source
+        self.filterFunc = filterFunc
+        self.burn = burn
+        self.day = day
+
+    def __call__(self):
+        mask = self.source() if callable(self.source) else self.source
+        return ((mask != 0) & (self.filterFunc(self.burn, self.day) != 0)).astype(np.uint8)
+
+class DayMasks(MutableMapping):
+    '''The {date: mask} dictionary of one burn of a Dataset.
+
+    A mask can be pending, only being built when it is first used: from
+    the coordinates of a saved dataset, or by a filter (see Dataset.filter).
+    Masks are shared between Datasets until one of them changes (see
+    Dataset.view), so the masks we hand out are read-only, and writable()
+    gives a private copy to change in place.'''
+
+    def __init__(self, masks=None, pending=None):
+        # {date: read-only mask}, plus the dates of masks that only we use
+        self._masks = {}
+        self._owned = set()
+        # {date: function that builds the mask}
+        self._pending = dict(pending) if pending is not None else {}
+        # cached counts of points, see count() and countBurned()
+        self._counts = {}
+        self._burned = {}
+        self._total = None
+        if masks is not None:
+            for date, mask in masks.items():
+                self[date] = mask
+
+    def coords(self, date):
+        '''(ys, xs) of the points of a day, without building its mask if we can help it'''
+        builder = self._pending.get(date)
+        if isinstance(builder, CoordinateMask):
+            return builder.coords()
+        return np.nonzero(self[date])
+
+    def shape(self, date):
+        builder = self._pending.get(date)
+        if isinstance(builder, CoordinateMask):
+            return builder.shape
+        return self[date].shape
+
+    def writable(self, date):
+        '''Return the mask of a day that can be changed in place, copying it if it is shared'''
+        if date not in self._owned:
+            self._masks[date] = np.array(self[date])
+            self._owned.add(date)
+            self._forget(date)
+        return self._masks[date]
+
+    def count(self, date):
+        '''How many points are on a day'''
+        if date in self._owned:
+            # it can be changed without us knowing, so don't trust a cached count
+            return int(np.count_nonzero(self._masks[date]))
+        if date not in self._counts:
+            builder = self._pending.get(date)
+            if isinstance(builder, CoordinateMask):
+                self._counts[date] = len(builder.ys)
+            else:
+                self._counts[date] = int(np.count_nonzero(self[date]))
+        return self._counts[date]
+
+    def countBurned(self, date, endingPerim):
+        '''How many of the points on a day burned by the end of it'''
+        if date in self._owned or date not in self._burned:
+            ys, xs = self.coords(date)
+            burned = int(np.count_nonzero(endingPerim[ys, xs] == 1))
+            if date in self._owned:
+                return burned
+            self._burned[date] = burned
+        return self._burned[date]
+
+    def total(self):
+        '''How many points there are on every day'''
+        if self._total is None or self._owned:
+            total = sum(self.count(date) for date in self)
+            if self._owned:
+                return total
+            self._total = total
+        return self._total
+
+    def _forget(self, date):
+        self._counts.pop(date, None)
+        self._burned.pop(date, None)
+        self._total = None
+
+    def share(self):
+        '''Return a new DayMasks with the same masks. The ones we can change
+        in place (see writable()) are copied, so changing them later, through
+        masks we've already handed out, doesn't change the new one.'''
+        shared = DayMasks(pending=self._pending)
+        shared._masks = {date:self._frozen(date) for date in self._masks}
+        shared._counts = dict(self._counts)
+        shared._burned = dict(self._burned)
+        shared._total = self._total
+        return shared
+
+    def filtered(self, filterFunc, burn):
+        '''Return a new DayMasks of just the points that also pass filterFunc(burn, day).
+        Nothing is computed until a mask is used, so filters can be chained cheaply.'''
+        pending = {}
+        for date in self:
+            source = self._frozen(date) if date in self._masks else self._pending[date]
+            pending[date] = FilteredMask(source, filterFunc, burn, burn.days[date])
+        return DayMasks(pending=pending)
+
+    def _frozen(self, date):
+        '''The mask of a day, copied if we might still change it in place'''
+        mask = self._masks[date]
+        return _readOnly(mask.copy()) if date in self._owned else mask
+
+    def __getitem__(self, date):
+        if date not in self._masks:
+            builder = self._pending[date]
+            self._masks[date] = _readOnly(builder())
+            del self._pending[date]
+        return self._masks[date]
+
+    def __setitem__(self, date, mask):
+        self._pending.pop(date, None)
+        self._owned.discard(date)
+        self._masks[date] = _frozen(mask)
+        self._forget(date)
+
+    def __delitem__(self, date):
+        if date in self._masks:
+            del self._masks[date]
+            self._owned.discard(date)
+        else:
+            del self._pending[date]
+        self._forget(date)
+
+    def __iter__(self):
+        return iter(sorted(set(self._masks) | set(self._pending)))
+
+    def __len__(self):
+        return len(self._masks) + len(self._pending)
+
+    def __repr__(self):
+        return "DayMasks({})".format(list(self))
+
+def _readOnly(mask):
+    view = np.asarray(mask).view()
+    view.flags.writeable = False
+    return view
+
+def _frozen(mask):
+    '''A read-only version of mask that nobody else can change either,
+    so it is copied unless it (and whatever it is a view of) is already read-only'''
+    mask = np.asarray(mask)
+    base = mask.base if isinstance(mask.base, np.ndarray) else None
+    if mask.flags.writeable or (base is not None and base.flags.writeable):
+        mask = mask.copy()
+    return _readOnly(mask)
+
 class Dataset(object):
     '''A set of Point objects'''
     VULNERABLE_RADIUS = 500
 
-    def __init__(self, data=None, points='all'):
+    def __init__(self, data=None, points='all', lazy=True):
         if data is None:
-            # get it all
-            data = rawdata.load()
+            # only load the burns and days we refer to, or else everything
+            referenced = referencedDays(points)
+            if referenced is None:
+                data = rawdata.load()
+            else:
+                data = rawdata.load(sorted(referenced), referenced, lazy=lazy)
         self.data = data
 
         self.points = self._decodePoints(points)
@@ -77,35 +562,58 @@ class Dataset(object):
 
     def _decodePoints(self, points):
         '''Attempt to decode an input into the form of
-        {str: {str:(nparray, nparray)}}, representing
-        {burnName:{date:(xseries, yseries)}}'''
+        {burnName: DayMasks}, where each DayMasks is {date: mask}'''
         if type(points) == str and points == 'all':
             points = {burnName:'all' for burnName in self.data.burns}
+        if isinstance(points, PointIndex):
+            points = points.toMasks(lambda burnName, date: self.data.burns[burnName].layerSize)
+        if callable(points):
+            # points is a filter function, which gives the mask of a burn and day.
+            # Only call it once a day is actually used
+            filterFunc = points
+            return {burnName:DayMasks(pending={date:partial(filterFunc, burn, day) for date, day in burn.days.items()})
+                    for burnName, burn in self.data.burns.items()}
         assert type(points) == dict, 'expected "all" or a dictionary for burns'
+        result = {}
         for burnName, dateDict in points.items():
             assert burnName in self.data.burns, 'Could not find burn {} in RawData {}'.format(burnName, self.data)
+            burn = self.data.burns[burnName]
             if type(dateDict) == str and dateDict == 'all':
-                dateDict = {date:'all' for date in self.data.burns[burnName].days}
-                points[burnName] = dateDict
+                dateDict = {date:'all' for date in burn.days}
+            for date in dateDict:
+                assert date in burn.days, 'Could not find date {} in self.data.burns[{}].days'.format(date, burnName)
+            if isinstance(dateDict, DayMasks):
+                # don't build the masks until they're needed
+                result[burnName] = dateDict
+                continue
+            masks = DayMasks()
             for date, mask in dateDict.items():
-                assert date in self.data.burns[burnName].days, 'Could not find date {} in self.data.burns[{}].days'.format(date, burnName)
                 if type(mask) == str and mask == 'all':
-                    perim = self.data.burns[burnName].days[date].startingPerim
-                    mask = np.ones_like(perim, dtype=np.uint8)
-                    dateDict[date] = mask
-        return points
+                    masks._pending[date] = partial(np.ones, burn.layerSize, dtype=np.uint8)
+                else:
+                    masks[date] = mask
+            result[burnName] = masks
+        return result
 
     def copy(self):
-        '''the underlying data doesn't need to be copied,
-        but the dict of points does, since they may change'''
-        newPoints = {}
-        for burnName in self.points:
-            burn = self.points[burnName]
-            d = {}
-            for date in burn:
-                d[date] = burn[date].copy()
-            newPoints[burnName] = d
-        return Dataset(self.data, newPoints)
+        '''The underlying data doesn't need to be copied, and neither do the
+        masks until one of the Datasets changes them, see view()'''
+        return self.view()
+
+    def view(self):
+        '''Return a new Dataset of the same points, which shares our masks.
+        Masks we can already change in place are copied now, the rest only
+        when either Dataset changes them through writableMask().'''
+        return Dataset(self.data, {burnName:masks.share() for burnName, masks in self.points.items()})
+
+    def filter(self, filterFunc):
+        '''Return a new Dataset of just our points that also pass filterFunc(burn, day),
+        eg ds.filter(Dataset.vulnerablePixels). Nothing is computed until a day is used.'''
+        return Dataset(self.data, {burnName:masks.filtered(filterFunc, self.data.burns[burnName]) for burnName, masks in self.points.items()})
+
+    def writableMask(self, burnName, date):
+        '''The mask of a day, which can be changed in place without changing any other Dataset'''
+        return self.points[burnName].writable(date)
 
     def getUsedBurnNamesAndDates(self):
         results = []
@@ -116,6 +624,10 @@ class Dataset(object):
                 results.append((name,date))
         return results
 
+    def pointIndex(self):
+        '''Return a PointIndex of every point in this dataset'''
+        return PointIndex.fromMasks(self.points)
+
     def getAllLayers(self, layerName):
         result = {}
         allBurnNames = self.points.keys()
@@ -156,11 +668,88 @@ class Dataset(object):
             for date, pointMask in dayDict.items():
                 yield self.data.burns[burnName].days[date], pointMask
 
-    def save(self, fname=None):
+    def save(self, fname=None, compress=False):
+        '''Save to output/datasets/fname/ in the sparse format, see saveSparse().
+        If fname ends in .npz it is saved in the old format of full masks.'''
+        if fname is None:
+            fname = strftime("%d%b%H-%M", localtime())
+        if fname.endswith('.npz'):
+            fname = fixFileName(fname)
+            np.savez_compressed(fname, **{burnName:dict(dayDict) for burnName, dayDict in self.points.items()})
+            return
+        saveSparse(self.points, fixDirName(fname), compress)
+
+    def saveIndex(self, fname=None):
+        '''Save just the coordinates of our points, which is much smaller and
+        faster than save() for sparse datasets. dataset.load() opens either.'''
         if fname is None:
             fname = strftime("%d%b%H-%M", localtime())
         fname = fixFileName(fname)
-        np.savez_compressed(fname, **self.points)
+        self.pointIndex().save(fname)
+
+    def split(self, ratios=None, method='random', blockSize=64, seed=None, guard=0):
+        '''Split into several Datasets that share our RawData, like util.partition().
+        With the default ratios=[.5] we get two halves, with ratios=[.6,.8]
+        we get 60%, 20% and 20% of the points.
+
+        method decides what has to stay together in one of the parts:
+            'random': nothing, points are assigned individually
+            'day': all the points of a day
+            'burn': all the points of a burn
+            'block': all the points of a burn within the same blockSize
+                square of pixels, on any day. AOIs overlap their neighbors,
+                so this keeps nearly identical samples out of different parts.
+        With method='block', points within guard pixels (in y and in x) of
+        a block that went to a different part are dropped, so no point of
+        one part is within guard pixels of a point of another, on any day.
+        With guard=AOIRadius, no AOI has the center of an AOI of another
+        part in it, and with guard=2*AOIRadius the AOIs don't overlap at all.
+        blockSize should be a good deal bigger than 2*guard, or most points
+        get dropped.
+        Whole groups are assigned, so the parts are only approximately the
+        requested sizes. If the groups are so coarse that a part would be
+        empty, a ValueError is raised.'''
+        if ratios is None:
+            ratios = [.5]
+        bounds = list(ratios) + [1]
+        if any(b < a for a, b in zip([0]+bounds, bounds)) or max(bounds) > 1:
+            raise ValueError("ratios must be increasing fractions, got {}".format(ratios))
+        if guard and method != 'block':
+            raise ValueError("A guard band only works with method='block', not {}".format(method))
+        rng = np.random.default_rng(seed)
+        index = self.pointIndex()
+        n = len(index)
+        if method == 'random':
+            groups = np.arange(n)
+        elif method == 'day':
+            groups = index.dayKeys()
+        elif method == 'burn':
+            groups = index.burnIds.astype(np.int64)
+        elif method == 'block':
+            by = (index.ys // blockSize).astype(np.int64)
+            bx = (index.xs // blockSize).astype(np.int64)
+            nby, nbx = (int(by.max())+1, int(bx.max())+1) if n else (1, 1)
+            groups = (index.burnIds.astype(np.int64) * nby + by) * nbx + bx
+        else:
+            raise ValueError("Unknown split method {}".format(method))
+        # put the groups in a random order, and then cut that order up
+        # so that each part gets its share of the points. A group that
+        # straddles a cut goes to whichever part holds most of it
+        uniqueGroups, groupOf, sizes = np.unique(groups, return_inverse=True, return_counts=True)
+        order = rng.permutation(len(uniqueGroups))
+        middles = np.cumsum(sizes[order]) - sizes[order] / 2
+        partOfGroup = np.empty(len(uniqueGroups), dtype=np.int64)
+        partOfGroup[order] = np.searchsorted(np.array(bounds) * n, middles, side='right')
+        parts = partOfGroup[groupOf]
+        if guard:
+            keep = _outsideGuard(index, parts, partOfGroup, uniqueGroups, nby, nbx, blockSize, guard, len(bounds))
+            index, parts = index.take(np.flatnonzero(keep)), parts[keep]
+        counts = np.bincount(parts, minlength=len(bounds))
+        hint = "a smaller blockSize or guard" if guard else "a smaller blockSize"
+        for i, (a, b) in enumerate(zip([0]+bounds, bounds)):
+            if n and b > a and counts[i] == 0:
+                raise ValueError("Part {} of the split is empty, there are only {} {} groups to split up. Try a finer method or {}".format(i, len(uniqueGroups), method, hint))
+        return [Dataset(self.data, index.take(np.flatnonzero(parts == i))) for i in range(len(bounds))]
 
     # @staticmethod
     # def toList(pointDict):
@@ -203,144 +792,142 @@ class Dataset(object):
     #             dictOfDays[d.date] = [Point(b.name,d.date,l) for l in locations]
     #     return points
 
-    # def evenOutPositiveAndNegative(self):
-    #     '''Make it so our dataset is a more even mixture of yes and no outputs'''
-    #     # yes will contain all 'did burn' points, no contains 'did not burn' points
-    #     yes = []
-    #     no =  []
-    #     for p in self.toList(self.points):
-    #         burnName, date, loc = p
-    #         burn = self.data.burns[burnName]
-    #         day = burn.days[date]
-    #         out = day.endingPerim[loc]
-    #         if out:
-    #             yes.append(p)
-    #         else:
-    #             no.append(p)
-    #     # shorten whichever is longer
-    #     if len(yes) > len(no):
-    #         random.shuffle(yes)
-    #         yes = yes[:len(no)]
-    #     else:
-    #         random.shuffle(no)
-    #         no = no[:len(yes)]
-    #
-    #     # recombine
-    #     return self.toDict(yes+no)
-    #
-    # def sample(self, goalNumber='max', sampleEvenly=True):
-    #     assert goalNumber == 'max' or (type(goalNumber)==int and goalNumber%2==0)
-    #     # map from (burnName, date) -> [pts that burned], [pts that didn't burn]
-    #     day2res = self.makeDay2burnedNotBurnedMap()
-    #     # print('day2res', day2res)
-    #     # find the limiting size for each day
-    #     limits = {day:min(len(yes), len(no)) for day, (yes, no) in day2res.items()}
-    #     print(limits)
-    #     if sampleEvenly:
-    #         # we must get the same number of samples from each day
-    #         # don't allow a large fire to have a bigger impact on training
-    #         if goalNumber == 'max':
-    #             # get as many samples as possible while maintaining even sampling
-    #             samplesPerDay = min(limits.values())
-    #             print("samplesPerDay", samplesPerDay)
-    #         else:
-    #             # aim for a specific number of samples and sample evenly
-    #             maxSamples = (2 * min(limits.values())) * len(limits)
-    #             if goalNumber > maxSamples:
-    #                 raise ValueError("Not able to get {} samples while maintaining even sampling from the available {}.".format(goalNumber, maxSamples))
-    #             ndays = len(limits)
-    #             samplesPerDay = goalNumber/(2*ndays)
-    #             samplesPerDay = int(math.ceil(samplesPerDay))
-    #     else:
-    #         # we don't care about sampling evenly. Larger Days will get more samples
-    #         if goalNumber == 'max':
-    #             # get as many samples as possible, whatever it takes
-    #             samplesPerDay = 'max'
-    #         else:
-    #             # aim for a specific number of samples and don't enforce even sampling
-    #             maxSamples = sum(limits.values()) * 2
-    #             if goalNumber > maxSamples:
-    #                 raise ValueError("Not able to get {} samples from the available {}.".format(goalNumber, maxSamples))
-    #     # order the days from most limiting to least limiting
-    #     days = sorted(limits, key=limits.get)
-    #     didBurnSamples = []
-    #     didNotBurnSamples = []
-    #     for i, day in enumerate(days):
-    #         didBurn, didNotBurn = day2res[day]
-    #         random.shuffle(didBurn)
-    #         random.shuffle(didNotBurn)
-    #         if sampleEvenly:
-    #             print('now samplesPerDay', samplesPerDay)
-    #             didBurnSamples.extend(didBurn[:samplesPerDay])
-    #             didNotBurnSamples.extend(didNotBurn[:samplesPerDay])
-    #         else:
-    #             if samplesPerDay == 'max':
-    #                 nsamples = min(len(didBurn), len(didNotBurn))
-    #                 didBurnSamples.extend(didBurn[:nsamples])
-    #                 didNotBurnSamples.extend(didNotBurn[:nsamples])
-    #             else:
-    #                 samplesToGo = goalNumber/2 - len(didBurnSamples)
-    #                 daysToGo = len(days)-i
-    #                 goalSamplesPerDay = int(math.ceil(samplesToGo/daysToGo))
-    #                 nsamples = min(goalSamplesPerDay, len(didBurn), len(didNotBurn))
-    #                 didBurnSamples.extend(didBurn[:nsamples])
-    #                 didNotBurnSamples.extend(didNotBurn[:nsamples])
-    #
-    #     # now shuffle, trim and split the samples
-    #     print('length of did and no burn samples', len(didBurnSamples), len(didNotBurnSamples))
-    #     random.shuffle(didBurnSamples)
-    #     random.shuffle(didNotBurnSamples)
-    #     if goalNumber != 'max':
-    #         didBurnSamples = didBurnSamples[:goalNumber//2]
-    #         didNotBurnSamples = didNotBurnSamples[:goalNumber//2]
-    #     samples = didBurnSamples + didNotBurnSamples
-    #     random.shuffle(samples)
-    #     print(len(samples), sum(limits.values()))
-    #     return samples
-    #
-    # def makeDay2burnedNotBurnedMap(self):
-    #     result = {}
-    #     for burnName, dayDict in self.points.items():
-    #         for date, ptList in dayDict.items():
-    #             day = self.data.getDay(burnName, date)
-    #             didBurn, didNotBurn = [], []
-    #             for pt in ptList:
-    #                 _,_,location = pt
-    #                 if day.endingPerim[location] == 1:
-    #                     didBurn.append(pt)
-    #                 else:
-    #                     didNotBurn.append(pt)
-    #             result[(burnName, date)] = (didBurn, didNotBurn)
-    #     return result
-    #
-    #
+    def evenOutPositiveAndNegative(self, seed=None):
+        '''Return a new Dataset that is an even mixture of yes and no outputs:
+        all of the points of the rarer output, plus a random selection of
+        the same number of points of the more common one.'''
+        rng = np.random.default_rng(seed)
+        days, yes, no = self._splitByOutcome()
+        yesCounts = np.array([len(y) for y in yes], dtype=np.int64)
+        noCounts = np.array([len(n) for n in no], dtype=np.int64)
+        # shorten whichever is longer
+        n = min(yesCounts.sum(), noCounts.sum())
+        yesCounts = _spreadAcrossDays(yesCounts, n, rng)
+        noCounts = _spreadAcrossDays(noCounts, n, rng)
+        return self._fromChosen(days, yes, no, yesCounts, noCounts, rng)
+
+    def sample(self, goalNumber='max', sampleEvenly=True, seed=None):
+        '''Return a new Dataset of goalNumber points, half that did burn and half that didn't.
+
+        If sampleEvenly, then every day contributes the same number of points,
+        so that a large fire doesn't have a bigger impact on training.
+        If goalNumber is 'max' we get as many as possible.'''
+        assert goalNumber == 'max' or (type(goalNumber)==int and goalNumber%2==0)
+        rng = np.random.default_rng(seed)
+        # the limiting size of each day, from the cached counts
+        days = sorted(self.getUsedBurnNamesAndDates())
+        burned = np.array([self.points[b].countBurned(d, self.data.getDay(b, d).endingPerim) for b, d in days], dtype=np.int64)
+        total = np.array([self.countDay(b, d) for b, d in days], dtype=np.int64)
+        limits = np.minimum(burned, total - burned)
+        ndays = len(days)
+        if ndays == 0:
+            if goalNumber not in ('max', 0):
+                raise ValueError("Not able to get {} samples from an empty Dataset.".format(goalNumber))
+            return Dataset(self.data, {})
+        if sampleEvenly:
+            if goalNumber == 'max':
+                # get as many samples as possible while maintaining even sampling
+                samplesPerDay = limits.min()
+            else:
+                # aim for a specific number of samples and sample evenly
+                maxSamples = (2 * limits.min()) * ndays
+                if goalNumber > maxSamples:
+                    raise ValueError("Not able to get {} samples while maintaining even sampling from the available {}.".format(goalNumber, maxSamples))
+                samplesPerDay = int(math.ceil(goalNumber/(2*ndays)))
+            counts = np.full(ndays, samplesPerDay, dtype=np.int64)
+        else:
+            if goalNumber == 'max':
+                # get as many samples as possible, whatever it takes
+                counts = limits.copy()
+            else:
+                # aim for a specific number of samples and don't enforce even sampling
+                maxSamples = limits.sum() * 2
+                if goalNumber > maxSamples:
+                    raise ValueError("Not able to get {} samples from the available {}.".format(goalNumber, maxSamples))
+                # go from the most limiting day to the least, spreading what's left over the rest
+                counts = np.zeros(ndays, dtype=np.int64)
+                chosen = 0
+                for i, day in enumerate(np.argsort(limits, kind='mergesort')):
+                    samplesToGo = goalNumber//2 - chosen
+                    daysToGo = ndays - i
+                    counts[day] = min(int(math.ceil(samplesToGo/daysToGo)), limits[day])
+                    chosen += counts[day]
+        days, yes, no = self._splitByOutcome()
+        yesCounts, noCounts = counts, counts
+        if goalNumber != 'max':
+            # rounding up may have given us a few too many, throw some out at random
+            yesCounts = _spreadAcrossDays(counts, goalNumber//2, rng)
+            noCounts = _spreadAcrossDays(counts, goalNumber//2, rng)
+        return self._fromChosen(days, yes, no, yesCounts, noCounts, rng)
+
+    def _splitByOutcome(self):
+        '''Return [(burnName, date)], and for each of those days the flat
+        indices of the points that did burn, and of those that didn't'''
+        days, yes, no = [], [], []
+        for burnName, dayDict in sorted(self.points.items()):
+            for date, mask in sorted(dayDict.items()):
+                used = np.asarray(mask).ravel() != 0
+                didBurn = self.data.getDay(burnName, date).endingPerim.ravel() == 1
+                days.append((burnName, date))
+                yes.append(np.flatnonzero(used & didBurn))
+                no.append(np.flatnonzero(used & ~didBurn))
+        return days, yes, no
+
+    def _fromChosen(self, days, yes, no, yesCounts, noCounts, rng):
+        '''Make a new Dataset by choosing yesCounts[i] and noCounts[i] random
+        points out of yes[i] and no[i] for every day'''
+        points = {}
+        for (burnName, date), y, n, ny, nn in zip(days, yes, no, yesCounts, noCounts):
+            shape = self.points[burnName][date].shape
+            mask = np.zeros(shape, dtype=np.uint8)
+            flat = mask.reshape(-1)
+            flat[rng.choice(y, int(ny), replace=False)] = 1
+            flat[rng.choice(n, int(nn), replace=False)] = 1
+            points.setdefault(burnName, {})[date] = mask
+        return Dataset(self.data, points)
+
     # @staticmethod
     # def allPixels(burn, day):
     #     return list(np.ndindex(burn.layerSize))
 
-    # @staticmethod
-    # def vulnerablePixels(burn, day, radius=VULNERABLE_RADIUS):
-    #     '''Return the indices of the pixels that close to the current fire perimeter'''
-    #     startingPerim = day.startingPerim
-    #     kernel = np.ones((3,3))
-    #     its = int(round((2*(radius/rawdata.PIXEL_SIZE)**2)**.5))
-    #     dilated = cv2.dilate(startingPerim, kernel, iterations=its)
-    #     border = dilated - startingPerim
-    #     ys, xs = np.where(border)
-    #     return list(zip(ys, xs))
+    @staticmethod
+    def vulnerablePixels(burn, day, radius=VULNERABLE_RADIUS):
+        '''Return a mask of the pixels within radius meters of the current
+        fire perimeter, not including the perimeter itself'''
+        return selection.dayRing(day, 0, radius)
+
+    @staticmethod
+    def ringPixels(minRadius, maxRadius):
+        '''Return a filter, usable like Dataset(data, Dataset.ringPixels(500, 1000)),
+        which selects the pixels between minRadius and maxRadius meters from
+        the current fire perimeter'''
+        def ring(burn, day):
+            return selection.dayRing(day, minRadius, maxRadius)
+        return ring
 
     def __len__(self):
-        total = 0
-        for dayDict in self.points.values():
-            for series in dayDict.values():
-                total += series.shape[1]
-        return total
+        return sum(masks.total() for masks in self.points.values())
+
+    def countDay(self, burnName, date):
+        '''How many points are on a day'''
+        return self.points[burnName].count(date)
+
+    def countBurnedAndNot(self):
+        '''Return how many of our points did burn, and how many didn't'''
+        burned = 0
+        for burnName, masks in self.points.items():
+            for date in masks:
+                endingPerim = self.data.getDay(burnName, date).endingPerim
+                burned += masks.countBurned(date, endingPerim)
+        return burned, len(self) - burned
 
     def __eq__(self, other):
-        if isinstance(other, Dataset):
-            return self.points == other.points
-        else:
+        if not isinstance(other, Dataset):
             return NotImplemented
+        days = sorted(self.getUsedBurnNamesAndDates())
+        if days != sorted(other.getUsedBurnNamesAndDates()):
+            return False
+        return all(np.array_equal(self.points[b][d] != 0, other.points[b][d] != 0) for b, d in days)
 
     def __repr__(self):
         # shorten the string repr of self.points
@@ -1,6 +1,7 @@
 import numpy as np
 import cv2
 from .datamodule import PIXEL_SIZE
+from . import selection
 
 class Dataset(object):
 
@@ -29,8 +30,6 @@ class Dataset(object):
         if radius is None:
             radius = self.VULNERABLE_RADIUS
         '''Return the indices of the pixels that close to the current fire perimeter'''
-        kernel = np.ones((3,3))
-        its = int(round((2*(radius/PIXEL_SIZE)**2)**.5))
-        dilated = cv2.dilate(startingPerim, kernel, iterations=its)
-        border = dilated - startingPerim
+        distances = selection.distanceFromPerim(startingPerim, PIXEL_SIZE)
+        border = selection.ringMask(distances, 0, radius)
         return np.where(border)
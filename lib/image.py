@@ -525,7 +525,7 @@ def apply_transform(x,
                     cval=0.):
     """Apply the image transformation specified by a matrix.
     # Arguments
-        x: 2D numpy array, single image.
+        x: 3D numpy array, single image with channels.
         transform_matrix: Numpy array specifying the geometric transformation.
         channel_axis: Index of axis for channels in the input tensor.
         fill_mode: Points outside the boundaries of the input
@@ -536,22 +536,20 @@ def apply_transform(x,
     # Returns
         The transformed version of the input.
     """
-    # np.savetxt('data/dembeforeapplytransform.csv', x[:,:,0], delimiter=',')
-    x = np.rollaxis(x, channel_axis, 0)
-    print('x is', x.shape)
-    final_affine_matrix = transform_matrix[:2, :2]
-    final_offset = transform_matrix[:2, 2]
-    channel_images = [ndi.interpolation.affine_transform(
-        x_channel,
+    # resample every channel in one pass: the matrix maps the two image
+    # axes like transform_matrix does, and leaves the channel axis alone
+    spatial = [axis for axis in range(x.ndim) if axis != channel_axis]
+    final_affine_matrix = np.eye(x.ndim)
+    final_affine_matrix[np.ix_(spatial, spatial)] = transform_matrix[:2, :2]
+    final_offset = np.zeros(x.ndim)
+    final_offset[spatial] = transform_matrix[:2, 2]
+    return ndi.interpolation.affine_transform(
+        x,
         final_affine_matrix,
         final_offset,
         order=0,
         mode=fill_mode,
-        cval=cval) for x_channel in x]
-    x = np.stack(channel_images, axis=0)
-    x = np.rollaxis(x, 0, channel_axis + 1)
-    # np.savetxt('data/demafterapplytransform.csv', x[:,:,0], delimiter=',')
-    return x
+        cval=cval)
 
 class ImageDataGenerator(object):
     """Generate minibatches of image data with real-time data augmentation.
@@ -0,0 +1,82 @@
+# layerstore.py
+'''On-disk, memory-mapped float32 copies of the raster layers of each burn.
+
+Opening a layer with util.openImg means decoding the TIFF and then running
+invalidPixelMask over it, which is slow. So the cleaned result (NoData pixels
+set to nan) is stored once as a .npy file, along with a mask of which pixels
+are valid. The cache is content-addressed: the file name is a hash of the
+source's path, size, and modification time, plus the parameters used to clean
+it. If any of those change then the layer simply gets rebuilt.
+
+After that, every open just memory-maps those files read-only, so only the
+parts of the layer that actually get touched are paged in from disk.'''
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from lib import util
+
+CACHE_DIR = 'data/_cache/layers/'
+
+# everything that affects how util.openImg cleans a layer. Bump the version
+# whenever openImg or invalidPixelMask change behavior.
+CLEANING_PARAMS = {'version': 1,
+                   'huge': util.HUGE,
+                   'floodfill': 'corners'}
+
+def openLayer(fname):
+    '''Return a read-only, memory-mapped float32 version of the image at fname'''
+    layerName, maskName = ensureCached(fname)
+    return np.load(layerName, mmap_mode='r')
+
+def openValidMask(fname):
+    '''Return a read-only, memory-mapped boolean mask of the valid pixels of
+    the image at fname'''
+    layerName, maskName = ensureCached(fname)
+    return np.load(maskName, mmap_mode='r')
+
+def ensureCached(fname):
+    '''Build the cache entry for fname if it doesn't exist yet.
+    Returns the file names of the cached layer and its validity mask.'''
+    if not os.path.exists(fname):
+        raise ValueError("The file {} does not exist.".format(fname))
+    key = fingerprint(fname)
+    layerName = CACHE_DIR + key + '.npy'
+    maskName = CACHE_DIR + key + '.valid.npy'
+    if not (os.path.exists(layerName) and os.path.exists(maskName)):
+        build(fname, layerName, maskName)
+    return layerName, maskName
+
+def fingerprint(fname):
+    '''Return a hex string which changes whenever the file at fname or the
+    cleaning parameters change'''
+    stat = os.stat(fname)
+    params = json.dumps(CLEANING_PARAMS, sort_keys=True)
+    paramsHash = hashlib.sha1(params.encode()).hexdigest()
+    ident = [os.path.abspath(fname), stat.st_size, stat.st_mtime_ns, paramsHash]
+    return hashlib.sha1(json.dumps(ident).encode()).hexdigest()
+
+def build(fname, layerName, maskName):
+    '''Clean the image at fname and store it and its validity mask.'''
+    img = util.openImg(fname).astype(np.float32, copy=False)
+    valid = np.isfinite(img)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    _save(maskName, valid)
+    _save(layerName, img)
+
+def clear():
+    '''Delete every cached layer. They will be rebuilt as they are needed.'''
+    if not os.path.exists(CACHE_DIR):
+        return
+    for fname in os.listdir(CACHE_DIR):
+        os.remove(CACHE_DIR + fname)
+
+def _save(fname, arr):
+    # write to a temporary file and then move it into place, so that other
+    # processes never memory-map a half-written file
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp, fname)
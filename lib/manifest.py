@@ -0,0 +1,110 @@
+# manifest.py
+'''A persisted summary of what data is on disk for each burn.
+
+Figuring out which dates of a burn are usable means looking at every perimeter
+and weather file. Instead of doing that on every start, we keep a manifest per
+burn that records, for every perimeter, its shape, dtype and a fingerprint
+(size and mtime) of the file, and for every weather file its fingerprint.
+
+The manifest is refreshed incrementally: the folders are listed and stat'ed
+(which is cheap), and only the files that are new or whose fingerprint changed
+get their headers read.'''
+import os
+import json
+
+from lib import util
+
+MANIFEST_DIR = 'data/_cache/manifests/'
+VERSION = 1
+
+_memoed = {}
+
+def load(burnName):
+    '''Return the up-to-date manifest for a burn, which looks like
+    {'perims': {date: {'file', 'size', 'mtime', 'valid', 'shape', 'dtype'}},
+     'weather': {date: {'file', 'size', 'mtime'}}}'''
+    old = _memoed.get(burnName)
+    if old is None:
+        old = _read(burnName)
+    new = refresh(burnName, old)
+    if new != old:
+        _write(burnName, new)
+    _memoed[burnName] = new
+    return new
+
+def perimDates(burnName):
+    '''All the dates that have a valid perimeter, sorted'''
+    perims = load(burnName)['perims']
+    return sorted(date for date, entry in perims.items() if entry['valid'])
+
+def weatherDates(burnName):
+    '''All the dates that have a weather file, sorted'''
+    return sorted(load(burnName)['weather'])
+
+def refresh(burnName, old):
+    '''Bring a manifest up to date with what is on disk'''
+    directory = 'data/{}/'.format(burnName)
+    if old is None:
+        old = {'perims':{}, 'weather':{}}
+
+    perims = {}
+    for fname in _listdir(directory+'perims/'):
+        date, ext = os.path.splitext(fname)
+        if ext != '.tif':
+            continue
+        path = directory+'perims/'+fname
+        entry = _fingerprint(path, fname)
+        prev = old['perims'].get(date)
+        if prev is not None and _sameFile(prev, entry):
+            perims[date] = prev
+            continue
+        info = util.tiffInfo(path)
+        entry['valid'] = info is not None
+        entry['shape'], entry['dtype'] = info if info is not None else (None, None)
+        perims[date] = entry
+
+    weather = {}
+    for fname in _listdir(directory+'weather/'):
+        date, ext = os.path.splitext(fname)
+        if ext != '.csv':
+            continue
+        weather[date] = _fingerprint(directory+'weather/'+fname, fname)
+
+    return {'version':VERSION, 'perims':perims, 'weather':weather}
+
+def _fingerprint(path, fname):
+    stat = os.stat(path)
+    return {'file':fname, 'size':stat.st_size, 'mtime':stat.st_mtime_ns}
+
+def _sameFile(a, b):
+    return a['file'] == b['file'] and a['size'] == b['size'] and a['mtime'] == b['mtime']
+
+def _listdir(directory):
+    if not os.path.isdir(directory):
+        return []
+    return util.listdir_nohidden(directory)
+
+def _manifestName(burnName):
+    return MANIFEST_DIR + burnName + '.json'
+
+def _read(burnName):
+    fname = _manifestName(burnName)
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname, 'r') as fp:
+            m = json.load(fp)
+    except ValueError:
+        # corrupted somehow, just rebuild it
+        return None
+    if m.get('version') != VERSION:
+        return None
+    return m
+
+def _write(burnName, m):
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    fname = _manifestName(burnName)
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump(m, fp, sort_keys=True, indent=1)
+    os.replace(tmp, fname)
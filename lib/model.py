@@ -1,14 +1,20 @@
+import os
 from time import localtime, strftime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 print('importing keras...')
 from keras.models import Sequential, Model
 from keras.layers import Dense, Activation, Dropout, Flatten, Concatenate, Input
 from keras.optimizers import SGD, RMSprop
-from keras.layers import Conv2D, MaxPooling2D, AveragePooling2D
+from keras.layers import Conv2D, MaxPooling2D, AveragePooling2D, Lambda
+from keras import backend as K
 print('done.')
+import numpy as np
 
 from lib import preprocess
 from lib import metrics
+from lib import pipeline
 
 class ImageBranch(Sequential):
     print("model.py")
@@ -35,6 +41,80 @@ class ImageBranch(Sequential):
             loss='binary_crossentropy',
             metrics=['accuracy'])
 
+class DenseImageBranch(Sequential):
+    '''A fully convolutional copy of an ImageBranch, followed by the image half
+    of FireModel's output layer.
+
+    Run over the padded stack of a whole day, pixel (y,x) of its output is
+    exactly what the ImageBranch computes for the AOI centered on (y,x),
+    but the convolutions are shared between neighbouring AOIs instead of
+    being redone for each one. Every stride-2 pool of the ImageBranch becomes
+    a stride-1 pool, and the layers after it are dilated by 2 more to match.
+    The output is the pre-sigmoid contribution of the image to the prediction.'''
+
+    def __init__(self, imageBranch):
+        super().__init__()
+        convs = [l for l in imageBranch.layers if isinstance(l, Conv2D)]
+        flatten = [l for l in imageBranch.layers if isinstance(l, Flatten)][0]
+        flatH, flatW, flatC = flatten.input_shape[1:]
+        nchannels = imageBranch.input_shape[-1]
+
+        self.add(AveragePooling2D(pool_size=(2,2), strides=(1,1), input_shape=(None, None, nchannels)))
+        self.conv1 = Conv2D(convs[0].filters, kernel_size=(3,3), dilation_rate=(2,2), activation='sigmoid')
+        self.add(self.conv1)
+        self.add(dilatedMaxPooling(2))
+        self.conv2 = Conv2D(convs[1].filters, (3,3), dilation_rate=(4,4), activation='relu')
+        self.add(self.conv2)
+        self.add(dilatedMaxPooling(4))
+        # the Dense layer looks at the whole flattened AOI, which is a (flatH, flatW) conv
+        self.dense = Conv2D(128, (flatH, flatW), dilation_rate=(8,8), activation='relu')
+        self.add(self.dense)
+        self.imageOutput = Conv2D(1, (1,1), use_bias=False)
+        self.add(self.imageOutput)
+
+    def copyWeights(self, imageBranch, outputKernel):
+        '''Take the weights of an ImageBranch, and the rows of the output layer's
+        kernel that multiply the ImageBranch's output'''
+        convs = [l for l in imageBranch.layers if isinstance(l, Conv2D)]
+        dense = [l for l in imageBranch.layers if isinstance(l, Dense)][0]
+        self.conv1.set_weights(convs[0].get_weights())
+        self.conv2.set_weights(convs[1].get_weights())
+        kernel, bias = dense.get_weights()
+        h, w = self.dense.kernel_size
+        # Flatten unrolls (h, w, channels) in C order, so this lines up
+        self.dense.set_weights([kernel.reshape(h, w, -1, kernel.shape[-1]), bias])
+        self.imageOutput.set_weights([np.asarray(outputKernel).reshape(1, 1, -1, 1)])
+
+def tileGrid(height, width, tileSize):
+    '''Split an image into (top, left, height, width) tiles of at most tileSize pixels square'''
+    tiles = []
+    for top in range(0, height, tileSize):
+        for left in range(0, width, tileSize):
+            tiles.append((top, left, min(tileSize, height-top), min(tileSize, width-left)))
+    return tiles
+
+def prefetch(executor, func, items, depth):
+    '''Like map(func, items), but with up to depth results being computed ahead'''
+    pending = deque()
+    items = iter(items)
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) > depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def dilatedMaxPooling(dilation):
+    '''A 2x2, stride 1 max pool whose inputs are `dilation` pixels apart'''
+    d = dilation
+    def pool(x):
+        return K.maximum(K.maximum(x[:, :-d, :-d, :], x[:, d:, :-d, :]),
+                         K.maximum(x[:, :-d, d:, :], x[:, d:, d:, :]))
+    def shape(s):
+        shrink = lambda n: None if n is None else n-d
+        return (s[0], shrink(s[1]), shrink(s[2]), s[3])
+    return Lambda(pool, output_shape=shape)
+
 class FireModel(Model):
 
     def __init__(self, preProcessor, weightsFileName=None):
@@ -59,14 +139,54 @@ class FireModel(Model):
 
         if weightsFileName is not None:
             self.load_weights(weightsFileName)
+            # use the same normalization the model was trained with
+            ppName = preprocess.fileNameFor(weightsFileName)
+            if os.path.exists(ppName):
+                saved = preprocess.PreProcessor.load(ppName)
+                if saved.whichLayers != list(self.preProcessor.whichLayers) or saved.AOIRadius != self.preProcessor.AOIRadius:
+                    raise ValueError("The weights in {} were trained with different layers or AOIRadius".format(weightsFileName))
+                self.preProcessor = saved
+
 
+    def fit(self, training, validate, epochs=80, batchSize=1000, stream=True, workers=0, queueDepth=8, augment=False, refit=False):
+        '''Train on the training Dataset.
 
-    def fit(self, training, validate, epochs=1):
-        # get the actual samples from the collection of points
-        (tinputs, toutputs), ptList = self.preProcessor.process(training)
-        (vinputs, voutputs), ptList = self.preProcessor.process(validate)
+        The PreProcessor is fit to the training Dataset, unless it already
+        has been (eg it was loaded along with saved weights) and refit is False,
+        so resuming training keeps the normalization the weights were trained with.
+
+        If stream is True, then the samples are extracted batch by batch as
+        they are needed, instead of all being held in memory at once.
+        If workers > 0, then those batches are prepared by that many background
+        processes, with up to queueDepth batches prepared ahead of time.
+        If augment, every training sample is randomly rotated and flipped as
+        it is served (only when streaming), see preprocess.augmentSamples().'''
+        if augment and not stream:
+            raise ValueError("Augmentation happens as batches are served, so it needs stream=True")
         print('training on ', training)
-        history = super().fit(tinputs, toutputs, batch_size = 1000, epochs=80, validation_data=(vinputs, voutputs))
+        # fix the normalization to the training set, so validation and
+        # everything we predict on later is scaled the same way
+        if refit or not self.preProcessor.isFit:
+            self.preProcessor.fit(training)
+        if stream and workers > 0:
+            tseq = self.preProcessor.flow(training, batchSize=batchSize, shuffle=True, augment=augment)
+            vseq = self.preProcessor.flow(validate, batchSize=batchSize, shuffle=False)
+            with pipeline.Prefetcher(tseq, workers, queueDepth) as tpre, \
+                 pipeline.Prefetcher(vseq, max(1, workers//2), queueDepth) as vpre:
+                history = super().fit_generator(iter(tpre), steps_per_epoch=len(tseq), epochs=epochs,
+                        validation_data=iter(vpre), validation_steps=len(vseq), workers=0)
+            print('training input pipeline:', tpre.stats())
+            print('validation input pipeline:', vpre.stats())
+        elif stream:
+            tseq = self.preProcessor.flow(training, batchSize=batchSize, shuffle=True, augment=augment)
+            vseq = self.preProcessor.flow(validate, batchSize=batchSize, shuffle=False)
+            history = super().fit_generator(tseq, steps_per_epoch=len(tseq), epochs=epochs,
+                    validation_data=vseq, validation_steps=len(vseq))
+        else:
+            # get the actual samples from the collection of points
+            (tinputs, toutputs), ptList = self.preProcessor.process(training)
+            (vinputs, voutputs), ptList = self.preProcessor.process(validate)
+            history = super().fit(tinputs, toutputs, batch_size=batchSize, epochs=epochs, validation_data=(vinputs, voutputs))
 
         self.saveWeights()
         return history
@@ -76,12 +196,82 @@ class FireModel(Model):
             timeString = strftime("%d%b%H:%M", localtime())
             fname = 'models/{}.h5'.format(timeString)
         self.save_weights(fname)
+        self.preProcessor.save(preprocess.fileNameFor(fname))
+
+    def predictDay(self, day, tileSize=None, maxMemory=None, workers=0):
+        '''Return the probability of every pixel of a Day burning, as an (h, w) raster.
+
+        This is the same as predict() on a Dataset of every pixel of the day,
+        but it runs the convolutions once over the whole day, see DenseImageBranch.
+
+        Big days are predicted in square tiles of tileSize pixels, each with
+        an AOIRadius border of context, and stitched back together, which
+        gives the same result. If tileSize isn't given, it is the biggest that
+        keeps one tile under maxMemory bytes (see tileSizeFor), or the
+        whole day if maxMemory isn't given either. If workers > 0, that
+        many threads build the next tiles' inputs while one is predicted.'''
+        h, w = day.startingPerim.shape[:2]
+        if tileSize is None:
+            tileSize = self.tileSizeFor(maxMemory) if maxMemory is not None else max(h, w)
+        weather = self.preProcessor.dayWeather(day)
+        dense = self.denseBranch()
+        tiles = tileGrid(h, w, tileSize)
+
+        def build(tile):
+            return self.preProcessor.padTile(day, *tile)
+
+        result = np.empty((h, w), dtype=np.float32)
+        if workers > 0:
+            executor = ThreadPoolExecutor(workers)
+            stacks = prefetch(executor, build, tiles, workers)
+        else:
+            executor = None
+            stacks = map(build, tiles)
+        try:
+            for (top, left, th, tw), padded in zip(tiles, stacks):
+                logits = dense.predict(padded[np.newaxis])[0, :th, :tw, 0]
+                result[top:top+th, left:left+tw] = self.outputFromImage(logits, weather)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return result
+
+    def tileSizeFor(self, maxMemory):
+        '''The biggest square tile that predictDay() can do in maxMemory bytes'''
+        # every layer of the DenseImageBranch keeps about one float per
+        # channel per pixel of the padded tile
+        channels = self.ib.input_shape[-1]
+        channels += sum(l.filters for l in self.ib.layers if isinstance(l, Conv2D)) * 2
+        channels += self.ib.output_shape[-1] + 1
+        bytesPerPixel = 4 * channels
+        side = int(np.sqrt(maxMemory / bytesPerPixel)) - 2*self.preProcessor.AOIRadius
+        if side < 1:
+            raise ValueError("{} bytes isn't enough to predict even one pixel at a time".format(maxMemory))
+        return side
+
+    def denseBranch(self):
+        '''The DenseImageBranch, with our current weights'''
+        if getattr(self, '_denseBranch', None) is None:
+            self._denseBranch = DenseImageBranch(self.ib)
+        kernel, bias = self.get_layer('output').get_weights()
+        nweather = self.preProcessor.numWeatherInputs
+        self._denseBranch.copyWeights(self.ib, kernel[nweather:])
+        return self._denseBranch
+
+    def outputFromImage(self, logits, weather):
+        '''Combine the output of a DenseImageBranch with a day's weather metrics
+        like our output layer would'''
+        kernel, bias = self.get_layer('output').get_weights()
+        nweather = self.preProcessor.numWeatherInputs
+        z = logits + (bias[0] + np.dot(weather, kernel[:nweather, 0]))
+        return (1 / (1 + np.exp(-z))).astype(np.float32)
 
-    def predict(self, dataset):
-        (inputs, outputs), ptList = self.preProcessor.process(dataset)
-        results = super().predict(inputs).flatten()
-        resultDict = {pt:pred for (pt, pred) in zip(ptList, results)}
-        return resultDict
+    def predict(self, dataset, batchSize=1000):
+        '''Return (PointIndex, predictions) for every point in the dataset,
+        where predictions[i] is the prediction for the point index[i]'''
+        sequence = self.preProcessor.flow(dataset, batchSize=batchSize, shuffle=False)
+        results = super().predict_generator(sequence, steps=len(sequence)).flatten()
+        return sequence.getPoints(), results
 
 from collections import namedtuple
 InputSettings = namedtuple('InputSettings', ['usedLayerNames', 'weatherMetrics', 'AOIRadius'])
@@ -0,0 +1,222 @@
+# normalization.py
+'''Statistics of the layers of a set of burns, and rescaling layers with them.
+
+The statistics are gathered in a single streaming pass: each layer is read a
+block of rows at a time and folded into a running LayerStats, so we never
+hold more than one block of pixels in memory (the layers themselves are
+memory-mapped, see layerstore.py).'''
+import numpy as np
+
+# how many rows of a layer to look at at once
+BLOCK_ROWS = 256
+# the most pixels we keep around per layer to estimate percentiles from
+MAX_SAMPLES = 100000
+
+class LayerStats(object):
+    '''Running statistics of the valid (finite) pixels of a layer:
+    count, min, max, mean and std, and optionally percentiles.
+
+    Percentiles are estimated from an evenly spaced subsample of the pixels,
+    so they are approximate for very large layers. The subsample is saved by
+    toDict(), so reloaded stats can still answer percentile queries.'''
+
+    def __init__(self, keepSamples=False):
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.mean = 0.0
+        # sum of squared differences from the mean
+        self.m2 = 0.0
+        self.keepSamples = keepSamples
+        self.samples = []
+        self._stride = 1
+
+    def update(self, layer):
+        '''Fold all of the pixels of a (possibly memory-mapped) layer into these stats'''
+        for start in range(0, layer.shape[0], BLOCK_ROWS):
+            block = np.asarray(layer[start:start+BLOCK_ROWS], dtype=np.float64)
+            self._updateValues(block[np.isfinite(block)])
+        return self
+
+    def _updateValues(self, values):
+        n = values.size
+        if n == 0:
+            return
+        mean = values.mean()
+        m2 = np.square(values - mean).sum()
+        self._combine(n, values.min(), values.max(), mean, m2)
+        if self.keepSamples:
+            # keep every stride'th pixel
+            self.samples.append(values[::self._stride].astype(np.float32))
+            self._shrinkSamples()
+
+    def _shrinkSamples(self):
+        # when we have too many samples, throw away every other
+        # one and start keeping half as many
+        while sum(len(s) for s in self.samples) > 2*MAX_SAMPLES:
+            self.samples = [np.concatenate(self.samples)[::2]]
+            self._stride *= 2
+
+    def _combine(self, n, lo, hi, mean, m2):
+        # Chan et al's parallel algorithm for combining means and variances
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * n / total
+        self.count = total
+        self.min = min(self.min, float(lo))
+        self.max = max(self.max, float(hi))
+
+    def merge(self, other):
+        '''Combine the stats of another LayerStats into this one'''
+        if other.count:
+            self._combine(other.count, other.min, other.max, other.mean, other.m2)
+            if self.keepSamples and other.samples:
+                # every sample should stand for the same number of pixels,
+                # so thin out whichever side was sampled more densely
+                stride = max(self._stride, other._stride)
+                mine = [np.concatenate(self.samples)[::stride//self._stride]] if self.samples else []
+                theirs = [np.concatenate(other.samples)[::stride//other._stride]]
+                self.samples = mine + theirs
+                self._stride = stride
+                self._shrinkSamples()
+        return self
+
+    @property
+    def std(self):
+        if self.count == 0:
+            return 0.0
+        return float(np.sqrt(self.m2 / self.count))
+
+    @property
+    def range(self):
+        if self.count == 0:
+            return 0.0
+        return self.max - self.min
+
+    def percentile(self, q):
+        if not self.keepSamples:
+            raise ValueError("These stats weren't gathered with keepSamples=True")
+        if not self.samples:
+            return np.nan
+        return float(np.percentile(np.concatenate(self.samples), q))
+
+    def toDict(self):
+        d = {'count':int(self.count), 'min':float(self.min), 'max':float(self.max),
+             'mean':float(self.mean), 'm2':float(self.m2)}
+        if self.keepSamples:
+            # at most 2*MAX_SAMPLES numbers, so only do it when asked for
+            samples = np.concatenate(self.samples) if self.samples else np.empty(0)
+            d['samples'] = samples.tolist()
+            d['stride'] = self._stride
+        return d
+
+    @staticmethod
+    def fromDict(d):
+        stats = LayerStats(keepSamples='samples' in d)
+        stats.count = d['count']
+        stats.min, stats.max = d['min'], d['max']
+        stats.mean, stats.m2 = d['mean'], d['m2']
+        if stats.keepSamples and d['samples']:
+            stats.samples = [np.array(d['samples'], dtype=np.float32)]
+            stats._stride = d['stride']
+        return stats
+
+    def __repr__(self):
+        return "LayerStats(count={}, min={}, max={}, mean={}, std={})".format(self.count, self.min, self.max, self.mean, self.std)
+
+class Normalizer(object):
+    '''Rescales layers to roughly 0-1, using statistics gathered over a set of burns.
+
+    Elevations are treated specially: every burn's dem is shifted to start at 0
+    (what matters is relative height within a burn, not height above sea
+    level), and then they are all scaled by the largest range of any burn.
+    All other layers are scaled by the min and max over all the burns.
+    With method='zscore' layers are instead shifted and scaled by their mean and std.
+    Invalid pixels always become 0.'''
+
+    def __init__(self, method='minmax', keepSamples=False):
+        if method not in ('minmax', 'zscore'):
+            raise ValueError("Unknown normalization method {}".format(method))
+        self.method = method
+        self.keepSamples = keepSamples
+        # {layerName: {burnName: LayerStats}}
+        self.burnStats = {}
+        # {layerName: LayerStats}, combined over all burns
+        self.stats = {}
+        # the minimum elevation of burns that weren't in the fit
+        self._unseenMins = {}
+
+    def fit(self, layers, knownStats=None):
+        '''Gather statistics from {layerName: {burnName: layer}}, looking at
+        every layer of every burn exactly once.
+        For burns in {layerName: {burnName: LayerStats}} knownStats, those
+        statistics are used instead of the layer's own.'''
+        knownStats = knownStats or {}
+        self.burnStats = {}
+        self.stats = {}
+        self._unseenMins = {}
+        for name, perBurn in layers.items():
+            self.burnStats[name] = {}
+            combined = LayerStats(self.keepSamples)
+            for burnName in sorted(perBurn):
+                stats = knownStats.get(name, {}).get(burnName)
+                if stats is None:
+                    stats = LayerStats(self.keepSamples).update(perBurn[burnName])
+                self.burnStats[name][burnName] = stats
+                combined.merge(stats)
+            self.stats[name] = combined
+        return self
+
+    def scaleAndOffset(self, layerName, burnName, layer):
+        '''Return (offset, scale) so that the normalized layer is (layer-offset)*scale'''
+        if layerName not in self.stats:
+            raise ValueError("The normalizer hasn't been fit for the layer {}".format(layerName))
+        if self.method == 'zscore':
+            stats = self.stats[layerName]
+            std = stats.std
+            return stats.mean, (1.0/std if std else 0.0)
+        if layerName == 'dem':
+            perBurn = self.burnStats[layerName]
+            if burnName in perBurn:
+                burnMin = perBurn[burnName].min
+            else:
+                # a burn we haven't seen before, just look at its own dem (once)
+                if burnName not in self._unseenMins:
+                    self._unseenMins[burnName] = LayerStats().update(layer).min
+                burnMin = self._unseenMins[burnName]
+            maxRange = max(s.range for s in perBurn.values())
+            return burnMin, (1.0/maxRange if maxRange else 0.0)
+        stats = self.stats[layerName]
+        return stats.min, (1.0/stats.range if stats.range else 0.0)
+
+    def apply(self, layerName, burnName, layer, out=None, window=None):
+        '''Normalize a layer, writing into out (which can be a view into a
+        bigger array, eg one channel of a stack) if given.
+        If window is given, only layer[window] is normalized.'''
+        offset, scale = self.scaleAndOffset(layerName, burnName, layer)
+        if window is not None:
+            layer = layer[window]
+        if out is None:
+            out = np.empty(layer.shape, dtype=np.float32)
+        np.subtract(layer, offset, out=out, casting='unsafe')
+        out *= scale
+        np.copyto(out, 0, where=~np.isfinite(out))
+        return out
+
+    def toDict(self):
+        '''A JSON-able description, so a fit Normalizer can be saved along with a model'''
+        return {'method':self.method,
+                'keepSamples':self.keepSamples,
+                'burnStats':{name:{b:s.toDict() for b, s in perBurn.items()} for name, perBurn in self.burnStats.items()},
+                'stats':{name:s.toDict() for name, s in self.stats.items()}}
+
+    @staticmethod
+    def fromDict(d):
+        normalizer = Normalizer(d['method'], d.get('keepSamples', False))
+        normalizer.burnStats = {name:{b:LayerStats.fromDict(s) for b, s in perBurn.items()} for name, perBurn in d['burnStats'].items()}
+        normalizer.stats = {name:LayerStats.fromDict(s) for name, s in d['stats'].items()}
+        return normalizer
+
+    def __repr__(self):
+        return "Normalizer({}, layers={})".format(self.method, sorted(self.stats))
@@ -0,0 +1,160 @@
+# pipeline.py
+'''Build training batches in background processes while the model trains.
+
+The padded layer stacks of an AOISequence are copied once into shared memory,
+so every worker reads the same stacks instead of getting its own pickled copy.
+The main process only hands out which sample indices go in each batch, and the
+workers send back the finished batches.'''
+import time
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import queue
+
+import numpy as np
+
+class Prefetcher(object):
+    '''Wraps an AOISequence so its batches are prepared by `workers` background
+    processes, with at most `queueDepth` batches prepared ahead of training.
+
+    Iterating over a Prefetcher yields batches forever, epoch after epoch, in
+    the same order the sequence itself would produce them.
+
+    While it runs it keeps track of how long the training loop spent waiting
+    for input vs doing its own work, see stats().'''
+
+    def __init__(self, sequence, workers=2, queueDepth=8):
+        if workers < 1:
+            raise ValueError("A Prefetcher needs at least one worker, got {}".format(workers))
+        if queueDepth < 1:
+            raise ValueError("queueDepth must be at least 1, got {}".format(queueDepth))
+        self.sequence = sequence
+        self.workers = workers
+        self.queueDepth = queueDepth
+
+        self.waitTime = 0.0
+        self.computeTime = 0.0
+        self.buildTime = 0.0
+        self.batchesServed = 0
+
+        self._processes = []
+        self._tasks = None
+        self._results = None
+
+    def start(self):
+        if self._processes:
+            return
+        ctx = multiprocessing.get_context()
+        shared = [_share(arr) for arr in self.sequence.padded]
+        # don't pickle the stacks when handing the sequence to the workers,
+        # they get rebuilt from the shared memory on the other side
+        padded = self.sequence.padded
+        self.sequence.padded = None
+        try:
+            self._tasks = ctx.Queue()
+            self._results = ctx.Queue()
+            for i in range(self.workers):
+                p = ctx.Process(target=_work, args=(self.sequence, shared, self._tasks, self._results))
+                p.daemon = True
+                p.start()
+                self._processes.append(p)
+        finally:
+            self.sequence.padded = padded
+        # the main process reads from shared memory too, so it isn't holding two copies
+        self.sequence.padded = [_view(s) for s in shared]
+
+    def close(self):
+        for p in self._processes:
+            self._tasks.put(None)
+        # a worker can't exit until the batches it finished have been taken
+        # off the queue, which they won't be if we stopped iterating early
+        while any(p.is_alive() for p in self._processes):
+            try:
+                self._results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for p in self._processes:
+            p.join()
+        self._processes = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __iter__(self):
+        self.start()
+        seq = self.sequence
+        epoch = 0
+        while True:
+            if seq.seed is not None:
+                np.random.seed(seq.seed + epoch)
+            seq._set_index_array()
+            nbatches = len(seq)
+            batches = (seq.index_array[seq.batch_size*i:seq.batch_size*(i+1)] for i in range(nbatches))
+
+            # keep at most queueDepth batches in flight, and hand them
+            # back in order even if the workers finish them out of order
+            submitted = 0
+            finished = {}
+            for i in range(nbatches):
+                while submitted < nbatches and submitted - i < self.queueDepth:
+                    indices = next(batches)
+                    # any randomness is drawn here, where the seed was set, not in the workers
+                    self._tasks.put((submitted, indices, seq.drawTransforms(indices)))
+                    submitted += 1
+                waitStart = time.time()
+                while i not in finished:
+                    try:
+                        batchIndex, batch, buildTime = self._results.get(timeout=60)
+                    except queue.Empty:
+                        self._checkWorkers()
+                        continue
+                    finished[batchIndex] = batch
+                    self.buildTime += buildTime
+                self.waitTime += time.time() - waitStart
+                batch = finished.pop(i)
+
+                self.batchesServed += 1
+                computeStart = time.time()
+                yield batch
+                self.computeTime += time.time() - computeStart
+            epoch += 1
+
+    def stats(self):
+        '''How the time was spent. If waiting dominates, add workers.'''
+        return {'batches': self.batchesServed,
+                'waitingForInput': self.waitTime,
+                'computing': self.computeTime,
+                'buildingBatches': self.buildTime}
+
+    def _checkWorkers(self):
+        for p in self._processes:
+            if not p.is_alive():
+                raise RuntimeError('A Prefetcher worker died with exit code {}'.format(p.exitcode))
+
+def _share(arr):
+    '''Copy an array into shared memory'''
+    arr = np.ascontiguousarray(arr)
+    buf = RawArray('b', arr.nbytes)
+    _view((buf, arr.shape, arr.dtype.str))[...] = arr
+    return buf, arr.shape, arr.dtype.str
+
+def _view(shared):
+    buf, shape, dtype = shared
+    return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+def _work(sequence, shared, tasks, results):
+    sequence.padded = [_view(s) for s in shared]
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        batchIndex, index_array, transforms = task
+        start = time.time()
+        batch = sequence.getBatch(index_array, transforms)
+        results.put((batchIndex, batch, time.time()-start))
@@ -1,5 +1,7 @@
 # preprocess.py
 from collections import namedtuple
+import os
+import json
 import numpy as np
 try:
     import matplotlib
@@ -10,6 +12,8 @@ except:
 
 
 from lib import util
+from lib import image
+from lib import normalization
 
 class PreProcessor(object):
     '''What is responsible for extracting the used data from the dataset and then
@@ -19,44 +23,301 @@ class PreProcessor(object):
         self.numWeatherInputs = numWeatherInputs
         self.whichLayers = whichLayers
         self.AOIRadius = AOIRadius
+        # a normalization.Normalizer. If None, each dataset is normalized by its own statistics
+        self.normalizer = None
+        # the min and range of each weather metric, see fit()
+        self.weatherMin = None
+        self.weatherRange = None
+
+    def fit(self, dataset):
+        '''Learn the normalization of the layers and weather metrics from a
+        (training) Dataset, so every other dataset gets scaled exactly the same.'''
+        self.normalizer = fitNormalizer(dataset, self.whichLayers)
+        arr = weatherArray(dataset).astype(np.float32)
+        if len(arr):
+            self.weatherMin = np.nanmin(arr, axis=0)
+            self.weatherRange = np.nanmax(arr, axis=0) - self.weatherMin
+        else:
+            self.weatherMin = self.weatherRange = None
+        return self
+
+    @property
+    def isFit(self):
+        return self.normalizer is not None and self.weatherMin is not None
+
+    def normalizeWeather(self, raw):
+        '''Scale an (ndays, numWeatherInputs) array of raw weather metrics.
+        If we haven't been fit, then it is scaled by its own min and max.'''
+        raw = np.asarray(raw, dtype=np.float32)
+        if self.weatherMin is None:
+            return util.normalize(raw, axis=0)
+        return scaleWeather(raw, self.weatherMin, self.weatherRange)
+
+    def prepareDay(self, day):
+        '''Return the normalized weather metrics and the padded layer stack of
+        a whole Day, for predicting every pixel of it at once.'''
+        h, w = day.startingPerim.shape[:2]
+        return self.dayWeather(day), self.padTile(day, 0, 0, h, w)
+
+    def dayWeather(self, day):
+        '''The normalized weather metrics of a single Day'''
+        if not self.isFit:
+            raise ValueError("The PreProcessor must be fit before preparing a single day")
+        return self.normalizeWeather([weatherMetrics(day.weather)])[0]
+
+    def padTile(self, day, top, left, height, width):
+        '''The padded layer stack of just a rectangle of a Day, see padWindow()'''
+        if not self.isFit:
+            raise ValueError("The PreProcessor must be fit before preparing a single day")
+        return padWindow(self.normalizer, self.whichLayers, day, self.AOIRadius, top, left, height, width)
+
+    def save(self, fname):
+        '''Save our settings and fit parameters as json'''
+        d = {'numWeatherInputs':self.numWeatherInputs,
+             'whichLayers':list(self.whichLayers),
+             'AOIRadius':self.AOIRadius,
+             'normalizer':self.normalizer.toDict() if self.normalizer is not None else None,
+             'weatherMin':self.weatherMin.tolist() if self.weatherMin is not None else None,
+             'weatherRange':self.weatherRange.tolist() if self.weatherRange is not None else None}
+        with open(fname, 'w') as fp:
+            json.dump(d, fp, indent=1)
+
+    @staticmethod
+    def load(fname):
+        with open(fname, 'r') as fp:
+            d = json.load(fp)
+        pp = PreProcessor(d['numWeatherInputs'], d['whichLayers'], d['AOIRadius'])
+        if d['normalizer'] is not None:
+            pp.normalizer = normalization.Normalizer.fromDict(d['normalizer'])
+        if d['weatherMin'] is not None:
+            pp.weatherMin = np.array(d['weatherMin'], dtype=np.float32)
+            pp.weatherRange = np.array(d['weatherRange'], dtype=np.float32)
+        return pp
 
     def process(self, dataset):
         '''Take a dataset and return the extracted inputs and outputs'''
-        # create dictionaries mapping from Point to actual data from that Point
-        metrics = calculateWeatherMetrics(dataset)
-        oneMetric = list(metrics.values())[0]
-        assert len(oneMetric) == self.numWeatherInputs, "Your weather metric function must return the expected number of metrics"
-        aois = getSpatialData(dataset, self.whichLayers, self.AOIRadius)
-        outs = getOutputs(dataset)
-
-        # convert the dictionaries into lists, then arrays
-        w, i, o = [], [], []
-        ptList = dataset.toList(dataset.points)
-        for pt in ptList:
-            burnName, date, location = pt
-            w.append(metrics[burnName, date])
-            i.append(aois[burnName, date, location])
-            o.append(outs[burnName, date, location])
-        weatherInputs = np.array(w)
-        imgInputs = np.array(i)
-        outputs = np.array(o)
-
-        return ([weatherInputs, imgInputs], outputs), ptList
+        sequence = self.flow(dataset, batchSize=None, shuffle=False)
+        if sequence.n == 0:
+            return sequence.getBatch(np.arange(0)), sequence.getPoints()
+        # one batch of every point, in order
+        return sequence[0], sequence.getPoints()
+
+    def flow(self, dataset, batchSize=1000, shuffle=True, seed=None, augment=False):
+        '''Return a keras Sequence which yields batches of ([weather, AOIs], outputs)
+        from the dataset, only extracting the AOIs of a batch when it is asked for.
+
+        If batchSize is None then everything comes in one batch.
+        If augment, every sample is randomly rotated and flipped, see augmentSamples().'''
+        return AOISequence(self, dataset, batchSize, shuffle, seed, augment)
+
+class AOISequence(image.Iterator):
+    '''Streams batches of samples from a Dataset.
+
+    The normalized layers of every used day are stacked and padded up front,
+    but the (2r+1, 2r+1, nchannels) AOI around each point is only cut out
+    when the batch containing it is requested. So memory use scales with the
+    batch size instead of with the number of points.
+
+    If augment, then every time a sample is served it is turned by a random
+    one of the 8 rotations and flips of a square, along with its wind
+    metrics, so training sees the landscape from every direction without any
+    augmented copies of the data being written to disk.'''
+
+    def __init__(self, preProcessor, dataset, batchSize=1000, shuffle=True, seed=None, augment=False):
+        self.preProcessor = preProcessor
+        self.AOIRadius = preProcessor.AOIRadius
+        self.days = dataset.getUsedBurnNamesAndDates()
+        self.augment = augment
+
+        self.rawWeather = weatherArray(dataset, self.days).astype(np.float32)
+        if self.days:
+            assert self.rawWeather.shape[1] == preProcessor.numWeatherInputs, "Your weather metric function must return the expected number of metrics"
+        self.normalizer = preProcessor.normalizer or fitNormalizer(dataset, preProcessor.whichLayers)
+        paddedLayers = getSpatialData(dataset, preProcessor.whichLayers, self.AOIRadius, self.normalizer)
+        self.weather = preProcessor.normalizeWeather(self.rawWeather) if self.days else self.rawWeather
+        self.padded = [paddedLayers[day] for day in self.days]
+        if augment and self.days:
+            # the wind metrics get shuffled around before they are scaled,
+            # so keep what normalizeWeather() scaled them by
+            if preProcessor.weatherMin is not None:
+                self.weatherMin, self.weatherRange = preProcessor.weatherMin, preProcessor.weatherRange
+            else:
+                self.weatherMin = np.nanmin(self.rawWeather, axis=0)
+                self.weatherRange = np.nanmax(self.rawWeather, axis=0) - self.weatherMin
+        # aspect is a compass direction too, so it gets turned along with the
+        # AOI. Which pixels have a direction comes from the raw layer, since
+        # NoData and the lowest aspect both normalize to 0
+        self.aspect = None
+        self.facing = None
+        if augment and 'aspect' in preProcessor.whichLayers:
+            offset, scale = self.normalizer.scaleAndOffset('aspect', None, None)
+            self.aspect = (preProcessor.whichLayers.index('aspect')+1, offset, scale)
+            byBurn = {burnName:padFacing(dataset.data.burns[burnName], self.AOIRadius) for burnName in {b for b, d in self.days}}
+            self.facing = [byBurn[burnName] for burnName, date in self.days]
+
+        # every point is identified by the index of its day and its location
+        self.index = dataset.pointIndex()
+        self.ys, self.xs = self.index.ys, self.index.xs
+        self.dayIds = np.empty(len(self.index), dtype=np.int32)
+        self.outputs = np.empty(len(self.index), dtype=np.float32)
+        dayLookup = {day:i for i, day in enumerate(self.days)}
+        for day, indices in self.index.days():
+            self.dayIds[indices] = dayLookup[day]
+            endingPerim = dataset.data.getDay(*day).endingPerim
+            self.outputs[indices] = endingPerim[self.ys[indices], self.xs[indices]]
+
+        n = len(self.ys)
+        if batchSize is None:
+            batchSize = max(n, 1)
+        super().__init__(n, batchSize, shuffle, seed)
+
+    def getPoints(self, index_array=None):
+        '''Return a PointIndex of the points at some sample indices, or all of them'''
+        if index_array is None:
+            return self.index
+        return self.index.take(index_array)
+
+    def drawTransforms(self, index_array):
+        '''Pick a random transform for each sample of a batch, see augmentSamples().
+        None if we aren't augmenting.'''
+        if not self.augment:
+            return None
+        return np.random.randint(len(TRANSFORMS), size=len(index_array)).astype(np.int8)
+
+    def getBatch(self, index_array, transforms=None):
+        '''Extract the samples at index_array, in that order.
+
+        If we are augmenting, each sample is turned by the matching entry of
+        transforms, which are drawn at random if not given.'''
+        diam = 2*self.AOIRadius+1
+        nchannels = len(self.preProcessor.whichLayers)+1
+        n = len(index_array)
+        imgs = np.empty((n, diam, diam, nchannels), dtype=np.float32)
+        facing = np.empty((n, diam, diam), dtype=bool) if self.facing is not None else None
+        dayIds = self.dayIds[index_array]
+        # samples from the same day are extracted together, so visit the
+        # batch in day order and put each day's AOIs where they belong
+        order = np.argsort(dayIds, kind='mergesort')
+        sortedDays = dayIds[order]
+        bounds = np.flatnonzero(np.diff(sortedDays)) + 1
+        for positions in np.split(order, bounds):
+            if len(positions) == 0:
+                continue
+            dayId = dayIds[positions[0]]
+            indices = index_array[positions]
+            if positions[-1] - positions[0] == len(positions) - 1:
+                # already contiguous in the batch, extract in place
+                out = imgs[positions[0]:positions[-1]+1]
+                extractMany(self.padded[dayId], self.ys[indices], self.xs[indices], self.AOIRadius, out=out)
+            else:
+                imgs[positions] = extractMany(self.padded[dayId], self.ys[indices], self.xs[indices], self.AOIRadius)
+            if facing is not None:
+                facing[positions] = extractMany(self.facing[dayId], self.ys[indices], self.xs[indices], self.AOIRadius)
+        if self.augment and n:
+            if transforms is None:
+                transforms = self.drawTransforms(index_array)
+            imgs, rawWeather = augmentSamples(imgs, self.rawWeather[dayIds], transforms, self.aspect, facing)
+            weather = scaleWeather(rawWeather, self.weatherMin, self.weatherRange)
+        else:
+            weather = self.weather[dayIds]
+        return [weather, imgs], self.outputs[index_array]
+
+    def _get_batches_of_transformed_samples(self, index_array):
+        return self.getBatch(index_array)
+
+# the 8 ways to turn a square AOI, as (number of quarter turns counterclockwise, flipped left to right first)
+TRANSFORMS = [(k, flip) for flip in (False, True) for k in range(4)]
+
+def augmentSamples(imgs, rawWeather, transforms, aspect=None, facing=None):
+    '''Rotate and flip a batch of (n, diam, diam, nchannels) AOIs, and turn
+    their (n, nmetrics) raw weather metrics to match.
+
+    transforms holds an index into TRANSFORMS for every sample. The wind
+    metrics say how much wind came from each compass direction, and the top
+    of an AOI is north, so eg after a quarter turn counterclockwise the wind
+    that came from the north now comes from the west.
+
+    If aspect is given, it is the (channel, offset, scale) of the normalized
+    aspect layer in imgs (see Normalizer.scaleAndOffset), whose directions
+    are turned the same way, see turnAspect(). facing is an (n, diam, diam)
+    mask of the pixels whose aspect is a direction (see padFacing()), or
+    None if every pixel whose aspect isn't negative is. Returns new arrays.'''
+    imgs = imgs.copy()
+    rawWeather = np.array(rawWeather, dtype=np.float32)
+    for t, (k, flip) in enumerate(TRANSFORMS):
+        which = np.flatnonzero(transforms == t)
+        if len(which) == 0 or t == 0:
+            continue
+        turned = imgs[which]
+        if flip:
+            turned = turned[:, :, ::-1]
+        turned = np.rot90(turned, k, axes=(1,2))
+        if aspect is not None:
+            channel, offset, scale = aspect
+            turnedFacing = None
+            if facing is not None:
+                turnedFacing = facing[which][:, :, ::-1] if flip else facing[which]
+                turnedFacing = np.rot90(turnedFacing, k, axes=(1,2))
+            turned = turned.copy()
+            turned[..., channel] = turnAspect(turned[..., channel], k, flip, offset, scale, turnedFacing)
+        imgs[which] = turned
+        rawWeather[which] = rawWeather[which][:, windPermutation(k, flip)]
+    return imgs, rawWeather
+
+def turnAspect(normalized, k, flip, offset, scale, facing=None):
+    '''Turn normalized aspect values (the compass direction each pixel faces,
+    normalized as (aspect-offset)*scale) the same as an AOI that is flipped
+    left to right (if flip) and then turned k quarter turns counterclockwise.
+
+    Only the pixels in the facing mask are turned, the rest (NoData, flat
+    ground, and the padding outside the burn) are left alone. Without a
+    mask, every pixel whose aspect isn't negative (flat) is turned.'''
+    if scale == 0:
+        return normalized
+    degrees = normalized / scale + offset
+    turned = degrees
+    if flip:
+        # mirroring east and west
+        turned = (360 - turned) % 360
+    # a quarter turn counterclockwise makes what faced north face west
+    turned = (turned - 90*k) % 360
+    if facing is None:
+        facing = degrees >= 0
+    return np.where(facing, (turned - offset) * scale, normalized).astype(normalized.dtype)
+
+def padFacing(burn, AOIRadius):
+    '''A mask of the pixels of a Burn whose aspect is a compass direction,
+    not NoData (nan) or flat (negative), padded by AOIRadius like padDay()'''
+    aspect = burn.layers['aspect']
+    h, w = aspect.shape[:2]
+    r = AOIRadius
+    padded = np.zeros((h+2*r, w+2*r), dtype=bool)
+    padded[r:r+h, r:r+w] = np.asarray(aspect) >= 0
+    return padded
+
+def windPermutation(k, flip):
+    '''The column order that turns the weather metrics the same as an AOI
+    that is flipped left to right (if flip) and then turned k quarter turns counterclockwise'''
+    n, s, e, w = [WEATHER_METRICS.index(m) for m in ('n', 's', 'e', 'w')]
+    perm = np.arange(len(WEATHER_METRICS))
+    if flip:
+        perm[[e, w]] = perm[[w, e]]
+    # one quarter turn counterclockwise: north goes to west, west to south, etc
+    step = np.arange(len(WEATHER_METRICS))
+    step[[w, s, e, n]] = [n, w, s, e]
+    for i in range(k % 4):
+        perm = perm[step]
+    return perm
+
+def scaleWeather(raw, weatherMin, weatherRange):
+    '''Scale raw weather metrics by the min and range of each metric'''
+    res = np.asarray(raw, dtype=np.float32) - weatherMin
+    # where dividing by zero, just use zero
+    return np.divide(res, weatherRange, out=np.zeros_like(res), where=weatherRange!=0)
 
 def calculateWeatherMetrics(dataset):
     '''Return a dictionary mapping from (burnName, date) id's to a dictionary of named weather metrics.'''
-    metrics = {}
-    for burnName, date in dataset.getUsedBurnNamesAndDates():
-        wm = dataset.data.getWeather(burnName, date)
-        # print('for the Day', burnName, date)
-        # print('weather matrix is', wm)
-        precip = totalPrecipitation(wm)
-        temp = maximumTemperature1(wm)
-        temp2 = maximumTemperature2(wm)
-        hum = averageHumidity(wm)
-        winds = windMetrics(wm)
-        entry = [precip, temp, temp2, hum] + winds
-        metrics[(burnName, date)] = entry
+    metrics = rawWeatherMetrics(dataset)
     # now normalize all of them
     # ensure we keep order
     ids = list(metrics.keys())
@@ -65,144 +326,145 @@ def calculateWeatherMetrics(dataset):
     metrics = {i:nums for (i,nums) in zip(ids, normed)}
     return metrics
 
-def getSpatialData(dataset, whichLayers, AOIRadius):
+def rawWeatherMetrics(dataset):
+    '''Same as calculateWeatherMetrics(), but before normalization'''
+    days = dataset.getUsedBurnNamesAndDates()
+    return {day:row for day, row in zip(days, weatherArray(dataset, days).tolist())}
+
+def weatherMetrics(wm):
+    '''The raw weather metrics of one day, from its weather matrix'''
+    return weatherFeatures([wm])[0].tolist()
+
+def weatherArray(dataset, days=None):
+    '''The raw weather metrics of the days of a dataset (by default every
+    used day), as an (ndays, nmetrics) array whose rows line up with days'''
+    if days is None:
+        days = dataset.getUsedBurnNamesAndDates()
+    return weatherFeatures([dataset.data.getWeather(burnName, date) for burnName, date in days])
+
+# the columns of weatherFeatures()
+WEATHER_METRICS = ['precip', 'temp', 'temp2', 'hum', 'n', 's', 'e', 'w']
+
+def weatherFeatures(weatherMatrices):
+    '''Compute the weather metrics of many days at once.
+
+    weatherMatrices is a list of (7, nhours) hourly weather matrices, which
+    don't need to have the same number of hours. They get stacked into one
+    (ndays, 7, maxHours) array so every metric of every day is computed by
+    one vectorized operation. Returns an (ndays, 8) array of
+    [precip, temp, temp2, hum, n, s, e, w], see WEATHER_METRICS.'''
+    matrices = [np.asarray(wm, dtype=np.float64).reshape(7, -1) for wm in weatherMatrices]
+    ndays = len(matrices)
+    nhours = max([wm.shape[1] for wm in matrices] + [0])
+    stacked = np.full((ndays, 7, nhours), np.nan)
+    valid = np.zeros((ndays, nhours), dtype=bool)
+    for i, wm in enumerate(matrices):
+        stacked[i, :, :wm.shape[1]] = wm
+        valid[i, :wm.shape[1]] = True
+    temp, dewpt, temp2, wdir, wspeed, precip, hum = stacked.transpose(1, 0, 2)
+
+    result = np.empty((ndays, len(WEATHER_METRICS)))
+    result[:,0] = np.where(valid, precip, 0).sum(axis=1)
+    result[:,1] = np.where(valid, temp, -np.inf).max(axis=1, initial=-np.inf)
+    result[:,2] = np.where(valid, temp2, -np.inf).max(axis=1, initial=-np.inf)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result[:,3] = np.where(valid, hum, 0).sum(axis=1) / valid.sum(axis=1)
+
+        # the wind components, from the direction the wind blows from
+        wDirRad = (np.pi/180) * wdir
+        northSouth = np.abs(np.cos(wDirRad) * wspeed)
+        eastWest = np.abs(np.sin(wDirRad) * wspeed)
+        fromNorth = valid & ((wdir < 90) | (wdir > 270))
+        fromSouth = valid & (wdir > 90) & (wdir < 270)
+        fromEast = valid & (wdir > 0) & (wdir < 180)
+        fromWest = valid & (wdir > 180) & (wdir < 360)
+    result[:,4] = np.where(fromNorth, northSouth, 0).sum(axis=1)
+    result[:,5] = np.where(fromSouth, northSouth, 0).sum(axis=1)
+    result[:,6] = np.where(fromEast, eastWest, 0).sum(axis=1)
+    result[:,7] = np.where(fromWest, eastWest, 0).sum(axis=1)
+    return result
+
+def getSpatialData(dataset, whichLayers, AOIRadius, normalizer=None):
+    '''Return a dictionary mapping from (burnName, date) id's to the normalized
+    layers of that day, stacked and padded by AOIRadius.
+
+    If no Normalizer is given, one is fit to the layers of this dataset.'''
+    if normalizer is None:
+        normalizer = fitNormalizer(dataset, whichLayers)
+    # now order them in the whichLayers order, normalize them, stack them, and pad them
+    return stackAndPad(normalizer, whichLayers, dataset, AOIRadius)
+
+def fitNormalizer(dataset, whichLayers):
     # for each channel in the dataset, get all of the used data
     layers = {layerName:dataset.getAllLayers(layerName) for layerName in whichLayers}
-    # now normalize them
-    layers = normalizeLayers(layers)
-    # now order them in the whichLayers order, stack them, and pad them
-    paddedLayers = stackAndPad(layers, whichLayers, dataset, AOIRadius)
-    # now extract out the aois around each point
-    result = {}
-    for pt in dataset.toList(dataset.points):
-        burnName, date, location = pt
-        padded = paddedLayers[(burnName, date)]
-        aoi = extract(padded, location, AOIRadius)
-        result[(burnName, date, location)] = aoi
-    # normalizeLayers(result)
-    return result
+    # augmented variants are normalized like the whole fire they came from,
+    # not by whatever part of it they kept
+    knownStats = {layerName:{} for layerName in whichLayers}
+    for burnName in dataset.points:
+        source = dataset.data.burns[burnName].source
+        if source is None:
+            continue
+        for layerName in whichLayers:
+            if layerName in source['stats']:
+                knownStats[layerName][burnName] = normalization.LayerStats.fromDict(source['stats'][layerName])
+    return normalization.Normalizer().fit(layers, knownStats)
 
 def normalizeLayers(layers):
+    '''Normalize {layerName: {burnName: layer}}, see normalization.Normalizer'''
+    normalizer = normalization.Normalizer().fit(layers)
     result = {}
-    for name, data in layers.items():
-        # if name != 'ndvi':
-        #     continue
-        if name == 'dem':
-            result[name] = normalizeElevations(data)
-        else:
-            # print('normalizing layer', name)
-            result[name] = normalizeNonElevations(data)
+    for name, perBurn in layers.items():
+        result[name] = {burnName:normalizer.apply(name, burnName, layer) for burnName, layer in perBurn.items()}
     return result
 
 def normalizeElevations(dems):
-    avgElevation = {}
-    validIndicesDict = {}
-    ranges = {}
-    for burnName, dem in dems.items():
-        validIndices = np.where(np.isfinite(dem))
-        validIndicesDict[burnName] = validIndices
-        validPixels = dem[validIndices]
-        avgElevation[burnName] = np.mean(validPixels)
-        ranges[burnName] = validPixels.max()-validPixels.min()
-
-        # vis = dem.copy()
-        # vis[validIndices] = 42
-        # plt.imshow(dem)
-        # plt.figure("valid")
-        # plt.imshow(vis)
-        # plt.show()
-    maxRange = max(ranges.values())
-    results = {}
-    for burnName, dem in dems.items():
-        validIndices = validIndicesDict[burnName]
-        # print(validIndices)
-        validPixels = dem[validIndices]
-        # print('valid pixels size:', validPixels.size)
-        normed = util.normalize(validPixels)
-        blank = np.zeros_like(dem, dtype=np.float32)
-        thisRange = ranges[burnName]
-        scaleFactor = thisRange/maxRange
-        blank[validIndices] = scaleFactor * normed
-        # print('scaleFactor is ', scaleFactor)
-        # plt.imshow(blank)
-        # plt.show()
-        results[burnName] = blank
-    return results
+    return normalizeLayers({'dem':dems})['dem']
 
 def normalizeNonElevations(nonDems):
-    splitIndices = [0]
-    validPixelsList = []
-    validIndicesList = []
-    names = list(nonDems.keys())
-    for name in names:
-        layer = nonDems[name]
-        validIndices = np.where(np.isfinite(layer))
-        validPixels = layer[validIndices]
-
-        # print('valid indices:', validIndices)
-        # print('len of valid pixels', validPixels.shape, len(validPixels))
-
-        # vis = np.zeros_like(layer)
-        # vis[validIndices] = 42
-        # plt.figure('before '+name)
-        # plt.imshow(layer)
-        # plt.figure('valid '+name)
-        # plt.imshow(vis)
-        # plt.show()
-
-        validPixelsList += validPixels.tolist()
-        splitIndices.append(splitIndices[-1] + len(validPixels))
-        validIndicesList.append(validIndices)
-
-    # now layers.shape is (nburns, height, width)
-    arr = np.array(validPixelsList)
-    # print('array is', arr, arr.min(), arr.max())
-    normed = util.normalize(arr)
-    # print(normed)
-    # print('split indices', splitIndices)
-    splitIndices = splitIndices[1:]
-    # print('split indices', splitIndices)
-    splitBackUp = np.split(normed, splitIndices)
-    # print('split back up:', splitBackUp.shape)
-    results = {}
-    for name, validIndices, normedPixels in zip(names,validIndicesList,splitBackUp):
-        # print(name, validIndices, normedPixels)
-        src = nonDems[name]
-        img = np.zeros_like(src, dtype=np.float32)
-        img[validIndices] = normedPixels
-        results[name] = img
-        # if normedPixels.size > 0:
-        #     print('min and max of ', name, normedPixels.min(), normedPixels.max())
-        # plt.figure('normed'+name)
-        # plt.imshow(img)
-    # plt.show()
-    return results
-
-def getOutputs(dataset):
-    result = {}
-    for pt in dataset.toList(dataset.points):
-        burnName, date, location = pt
-        out = dataset.data.getOutput(burnName, date, location)
-        result[(burnName, date, location)] = out
-    return result
+    # any name but 'dem' is treated the same
+    return normalizeLayers({'layer':nonDems})['layer']
 
-def stackAndPad(layerDict, whichLayers, dataset, AOIRadius):
+def fileNameFor(weightsFileName):
+    '''Where the PreProcessor for some model weights is saved'''
+    return os.path.splitext(weightsFileName)[0] + '.preprocessor.json'
+
+def stackAndPad(normalizer, whichLayers, dataset, AOIRadius):
     result = {}
     for burnName, date in dataset.getUsedBurnNamesAndDates():
-        # guarantee that the perim mask is just 0s and 1s
         day = dataset.data.burns[burnName].days[date]
-        sp = day.startingPerim
-        sp[sp!=0]=1
-
-        layers = [layerDict[layerName][burnName] for layerName in whichLayers]
-        layers = [sp] + layers
-        stacked = np.dstack(layers)
-        r = AOIRadius
-        # pad with zeros around border of image
-        padded = np.lib.pad(stacked, ((r,r),(r,r),(0,0)), 'constant')
-        result[(burnName, date)] = padded
+        result[(burnName, date)] = padDay(normalizer, whichLayers, day, AOIRadius)
     return result
 
+def padDay(normalizer, whichLayers, day, AOIRadius):
+    '''Stack the starting perimeter and the normalized layers of a Day, padded by AOIRadius'''
+    h, w = day.startingPerim.shape[:2]
+    return padWindow(normalizer, whichLayers, day, AOIRadius, 0, 0, h, w)
+
+def padWindow(normalizer, whichLayers, day, AOIRadius, top, left, height, width):
+    '''Same as padDay(), but only for the rectangle of the day starting at
+    (top, left), plus a border of AOIRadius around it. This is exactly the
+    matching piece of padDay(), so anything outside of the day is zeros.
+    Only that part of the (memory-mapped) layers gets read.'''
+    r = AOIRadius
+    burn = day.burn
+    sp = day.startingPerim
+    h, w = sp.shape[:2]
+    # pad with zeros around border of image
+    padded = np.zeros((height+2*r, width+2*r, len(whichLayers)+1), dtype=np.float32)
+    # the part of the day that lands in padded
+    y0, y1 = max(top-r, 0), min(top+height+r, h)
+    x0, x1 = max(left-r, 0), min(left+width+r, w)
+    if y0 >= y1 or x0 >= x1:
+        return padded
+    window = (slice(y0, y1), slice(x0, x1))
+    inside = padded[y0-(top-r):y1-(top-r), x0-(left-r):x1-(left-r)]
+    # guarantee that the perim mask is just 0s and 1s
+    inside[:,:,0] = sp[window] != 0
+    # normalize each layer straight into its channel
+    for i, layerName in enumerate(whichLayers):
+        normalizer.apply(layerName, burn.name, burn.layers[layerName], out=inside[:,:,i+1], window=window)
+    return padded
+
 def extract(padded, location, AOIRadius):
     '''Assume padded is bordered by radius self.inputSettings.AOIRadius'''
     y,x = location
@@ -215,6 +477,47 @@ def extract(padded, location, AOIRadius):
     # print(stacked.shape, padded.shape)s
     return aoi
 
+def extractMany(padded, ys, xs, AOIRadius, out=None, chunkSize=64):
+    '''Vectorized version of extract(): get the AOIs around many locations at once.
+
+    ys and xs are integer arrays of locations in the unpadded image.
+    Returns (or fills in out with) an array of shape (N, 2r+1, 2r+1, nchannels)'''
+    r = AOIRadius
+    diam = 2*r+1
+    padded = np.ascontiguousarray(padded)
+    ph, pw = padded.shape[:2]
+    h, w = ph-2*r, pw-2*r
+    ys = np.asarray(ys, dtype=np.intp)
+    xs = np.asarray(xs, dtype=np.intp)
+    if out is None:
+        out = np.empty((len(ys), diam, diam)+padded.shape[2:], dtype=padded.dtype)
+    if not out.flags['C_CONTIGUOUS']:
+        raise ValueError("out must be C contiguous")
+    if len(ys) == 0:
+        return out
+    if ys.min() < 0 or ys.max() >= h or xs.min() < 0 or xs.max() >= w:
+        raise ValueError("Locations must be inside the unpadded image of shape {}".format((h,w)))
+
+    # Make a (read only) view of padded where windows[i] is the AOI whose top
+    # left corner is at flat index i of padded. Then the AOIs can be gathered
+    # with fancy indexing, which only touches the windows we ask for.
+    # Each row of an AOI (all of its columns and channels) is contiguous in
+    # padded, so treat it as one axis so the gather copies whole rows at a time.
+    nchannels = int(np.prod(padded.shape[2:]))
+    rowStride, colStride = padded.strides[:2]
+    nwindows = (h-1)*pw + w
+    windows = np.lib.stride_tricks.as_strided(padded,
+            shape=(nwindows, diam, diam*nchannels),
+            strides=(colStride, rowStride, padded.itemsize),
+            writeable=False)
+    flatOut = out.reshape(len(ys), diam, diam*nchannels)
+    flatIndices = ys*pw + xs
+    # go in chunks to bound the size of the temporary that indexing creates
+    for start in range(0, len(flatIndices), chunkSize):
+        end = start+chunkSize
+        flatOut[start:end] = windows[flatIndices[start:end]]
+    return out
+
 # =================================================================
 # utility functions
 
@@ -235,26 +538,8 @@ def maximumTemperature2(weatherMatrix):
     return max(temp2)
 
 def windMetrics(weatherMatrix):
-    temp, dewpt, temp2, wdir, wspeed, precip, hum = weatherMatrix
-    wDirRad = [(np.pi/180) * wDirDeg for wDirDeg in wdir]
-    n, s, e, w = 0, 0, 0, 0
-    for hr in range(len(wdir)):
-        # print(wdir[i], wDirRad[i], wspeed[i])
-        if wdir[hr] > 90 and wdir[hr] < 270: #from south
-            # print('south!', -np.cos(wDirRad[i]) * wspeed[i])
-            s += abs(np.cos(wDirRad[hr]) * wspeed[hr])
-        if wdir[hr] < 90 or wdir[hr] > 270: #from north
-            # print('north!', np.cos(wDirRad[i]) * wspeed[i])
-            n += abs(np.cos(wDirRad[hr]) * wspeed[hr])
-        if wdir[hr] < 360 and wdir[hr] > 180: #from west
-            # print('west!', -np.sin(wDirRad[i]) * wspeed[i])
-            w += abs(np.sin(wDirRad[hr]) * wspeed[hr])
-        if wdir[hr] > 0 and wdir[hr] < 180: #from east
-            # print('east!',np.sin(wDirRad[i]) * wspeed[i])
-            e += abs(np.sin(wDirRad[hr]) * wspeed[hr])
-    components = [n, s, e, w]
-    # print(weather)
-    return components
+    '''The [n, s, e, w] wind components of one day, see weatherFeatures()'''
+    return weatherFeatures([weatherMatrix])[0, 4:].tolist()
 
 # =========================================================
 
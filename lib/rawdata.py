@@ -1,24 +1,27 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import numpy as np
 import cv2
 
 from lib import util
+from lib import layerstore
+from lib import manifest
+from lib import weather
 
 PIXEL_SIZE = 30
 _memoedAllBurns = None
 
 def availableBurns():
-    return util.listdir_nohidden('data/')
+    '''Return the names of all the burns that have at least one usable date'''
+    burns = [b for b in util.listdir_nohidden('data/') if os.path.isdir('data/'+b)]
+    return sorted(b for b in burns if availableDates(b))
 
 def availableDates(burnName):
     '''Given a fire, return a list of all dates that we can train on'''
-    directory = 'data/{}/'.format(burnName)
-
-    weatherFiles = util.listdir_nohidden(directory+'weather/')
-    weatherDates = [fname[:-len('.csv')] for fname in weatherFiles]
-
-    perimFiles = util.listdir_nohidden(directory+'perims/')
-    perimDates = [fname[:-len('.tif')] for fname in perimFiles if isValidImg(directory+'perims/'+fname)]
+    perimDates = set(manifest.perimDates(burnName))
+    weatherDates = set(manifest.weatherDates(burnName))
 
     # we can only use days which have perimeter data on the following day
     daysWithFollowingPerims = []
@@ -43,25 +46,101 @@ def possibleNextDates(dateString):
     return guess1, guess2
 
 def isValidImg(imgName):
-    img = cv2.imread(imgName, cv2.IMREAD_UNCHANGED)
-    return img is not None
+    '''Check that an image can be opened by just reading its header'''
+    return util.tiffInfo(imgName) is not None
 
-def load(burnNames='all', dates='all'):
+def load(burnNames='all', dates='all', workers=1, processes=False, lazy=False):
+    '''Load the RawData for a set of burns and dates.
+
+    Burns and days are opened concurrently when workers > 1, using threads,
+    or separate processes if processes=True. workers=None uses every core.
+    The result is the same no matter how many workers are used.
+    If lazy, the weather and perimeters of each day aren't opened until they are used.'''
     global _memoedAllBurns
     if _memoedAllBurns and burnNames=='all' and dates=='all':
         return _memoedAllBurns
+    loadingEverything = burnNames=='all' and dates=='all' and not lazy
     if burnNames == 'all':
-        burnNames = util.listdir_nohidden('data/')
+        burnNames = availableBurns()
     if dates == 'all':
-        burns = {n:Burn.load(n, 'all') for n in burnNames}
-    else:
-        # assumes dates is a dict, with keys being burnNames and vals being dates
-        burns = {n:Burn.load(n, dates[n]) for n in burnNames}
+        dates = {n:'all' for n in burnNames}
+    # otherwise, assumes dates is a dict, with keys being burnNames and vals being dates
+    burns = _loadBurns(burnNames, dates, workers, processes, lazy)
     result = RawData(burns)
-    if burnNames=='all' and dates=='all':
+    if loadingEverything:
         _memoedAllBurns = result
     return result
 
+def _loadBurns(burnNames, dates, workers=1, processes=False, lazy=False):
+    '''Open all of the burns, and then all of the days of every burn'''
+    if workers is None:
+        workers = os.cpu_count()
+    if workers > 1:
+        Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        pool = Executor(workers)
+        mapper = pool.map
+    else:
+        pool = None
+        mapper = map
+    try:
+        # make sure the layer and weather caches are built, this is the expensive part of a Burn
+        list(mapper(_cacheLayers, burnNames))
+        burns = {n:Burn(n) for n in burnNames}
+
+        jobs = []
+        for n in burnNames:
+            ds = availableDates(n) if dates[n] == 'all' else dates[n]
+            jobs.extend((n, d) for d in ds)
+        if lazy:
+            for n, d in jobs:
+                burns[n].days[d] = Day(burns[n], d, lazy=True)
+            return burns
+        # map() keeps the order of the jobs, so this is deterministic
+        for (n, d), (weather, start, end) in zip(jobs, mapper(_openDay, jobs)):
+            burn = burns[n]
+            burn.days[d] = Day(burn, d, weather, start, end)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return burns
+
+def _cacheLayers(burnName):
+    for fname in Burn.layerFileNames(burnName).values():
+        layerstore.ensureCached(fname)
+    # parse all the new weather of the burn at once, so the
+    # per-day jobs only ever read the weather cache
+    weather.refresh(burnName)
+
+def _openDay(job):
+    burnName, date = job
+    return (openWeather(burnName, date),
+            openStartingPerim(burnName, date),
+            openEndingPerim(burnName, date))
+
+def openWeather(burnName, date):
+    # only cols 5-11 are actual data, see weather.py
+    return weather.weatherMatrix(burnName, date)
+
+def openStartingPerim(burnName, date):
+    fname = 'data/{}/perims/{}.tif'.format(burnName, date)
+    perim = cv2.imread(fname, cv2.IMREAD_UNCHANGED)
+    if perim is None:
+        raise RuntimeError('Could not find a perimeter for the fire {} for the day {}'.format(burnName, date))
+    perim[perim!=0] = 255
+    return perim
+
+def openEndingPerim(burnName, date):
+    guess1, guess2 = possibleNextDates(date)
+    fname = 'data/{}/perims/{}.tif'.format(burnName, guess1)
+    perim = cv2.imread(fname, cv2.IMREAD_UNCHANGED)
+    if perim is None:
+        # overflowed the month, that file didnt exist
+        fname = 'data/{}/perims/{}.tif'.format(burnName, guess2)
+        perim = cv2.imread(fname, cv2.IMREAD_UNCHANGED)
+        if perim is None:
+            raise RuntimeError('Could not open a perimeter for the fire {} for the day {} or {}'.format(burnName, guess1, guess2))
+    return perim
+
 class RawData(object):
 
     def __init__(self, burns):
@@ -88,34 +167,24 @@ class RawData(object):
 
 class Burn(object):
 
-    def __init__(self, name, days=None, layers=None):
+    def __init__(self, name, days=None, layers=None, source=None):
         self.name = name
         self.days = {} if days is None else days
         self.layers = layers if layers is not None else self.loadLayers()
+        # if this burn is an augmented variant of another fire, where it came
+        # from: the fire, the angle it was turned by, the 'window' of the fire
+        # it was cut from (if it was) and the 'stats' of the layers of the
+        # whole fire, which it gets normalized with. See lib/augmentation.py
+        self.source = source if source is not None else Burn.loadSource(name)
 
         # what is the height and width of a layer of data
         self.layerSize = list(self.layers.values())[0].shape[:2]
 
     def loadLayers(self):
-        folder = 'data/{}/'.format(self.name)
-        dem = util.openImg(folder+'dem.tif')
-        # slope = util.openImg(folder+'slope.tif')
-        band_2 = util.openImg(folder+'band_2.tif')
-        band_3 = util.openImg(folder+'band_3.tif')
-        band_4 = util.openImg(folder+'band_4.tif')
-        band_5 = util.openImg(folder+'band_5.tif')
-        ndvi = util.openImg(folder+'ndvi.tif')
-        aspect = util.openImg(folder+'aspect.tif')
-        # r,g,b,nir = cv2.split(landsat)
-
-        layers = {'dem':dem,
-                # 'slope':slope,
-                'ndvi':ndvi,
-                'aspect':aspect,
-                'band_4':band_4,
-                'band_3':band_3,
-                'band_2':band_2,
-                'band_5':band_5}
+        '''Open every layer as a read-only memory map, so only the parts of a
+        layer that actually get used are read from disk.'''
+        fnames = Burn.layerFileNames(self.name)
+        layers = {name:layerstore.openLayer(fname) for name, fname in fnames.items()}
 
         # ok, now we have to make sure that all of the NoData values are set to 0
         #the NV pixels occur outside of our AOIRadius
@@ -127,52 +196,82 @@ class Burn(object):
         return layers
 
     @staticmethod
-    def load(burnName, dates='all'):
-        burn = Burn(burnName)
-        if dates == 'all':
-            dates = availableDates(burnName)
-        days = {date:Day(burn, date) for date in dates}
-        burn.days = days
-        return burn
+    def layerFileNames(burnName):
+        folder = 'data/{}/'.format(burnName)
+        return {'dem':folder+'dem.tif',
+                # 'slope':folder+'slope.tif',
+                'ndvi':folder+'ndvi.tif',
+                'aspect':folder+'aspect.tif',
+                'band_4':folder+'band_4.tif',
+                'band_3':folder+'band_3.tif',
+                'band_2':folder+'band_2.tif',
+                'band_5':folder+'band_5.tif'}
+
+    @staticmethod
+    def loadSource(burnName):
+        fname = 'data/{}/source.json'.format(burnName)
+        if not os.path.exists(fname):
+            return None
+        with open(fname, 'r') as fp:
+            return json.load(fp)
+
+    @staticmethod
+    def load(burnName, dates='all', workers=1, processes=False, lazy=False):
+        return _loadBurns([burnName], {burnName:dates}, workers, processes, lazy)[burnName]
 
     def __repr__(self):
         return "Burn({}, {})".format(self.name, [d.date for d in self.days.values()])
 
 class Day(object):
 
-    def __init__(self, burn, date, weather=None, startingPerim=None, endingPerim=None):
+    def __init__(self, burn, date, weather=None, startingPerim=None, endingPerim=None, lazy=False):
         self.burn = burn
         self.date = date
-        self.weather = weather             if weather       is not None else self.loadWeather()
-        self.startingPerim = startingPerim if startingPerim is not None else self.loadStartingPerim()
-        self.endingPerim = endingPerim     if endingPerim   is not None else self.loadEndingPerim()
+        self._weather = weather
+        self._startingPerim = startingPerim
+        self._endingPerim = endingPerim
+        if not lazy:
+            # open everything now instead of when it is first used
+            self.weather, self.startingPerim, self.endingPerim
+
+    @property
+    def weather(self):
+        if self._weather is None:
+            self._weather = self.loadWeather()
+        return self._weather
+
+    @weather.setter
+    def weather(self, weather):
+        self._weather = weather
+
+    @property
+    def startingPerim(self):
+        if self._startingPerim is None:
+            self._startingPerim = self.loadStartingPerim()
+        return self._startingPerim
+
+    @startingPerim.setter
+    def startingPerim(self, perim):
+        self._startingPerim = perim
+
+    @property
+    def endingPerim(self):
+        if self._endingPerim is None:
+            self._endingPerim = self.loadEndingPerim()
+        return self._endingPerim
+
+    @endingPerim.setter
+    def endingPerim(self, perim):
+        self._endingPerim = perim
 
     def loadWeather(self):
-        fname = 'data/{}/weather/{}.csv'.format(self.burn.name, self.date)
-        # the first row is the headers, and only cols 4-11 are actual data
-        data = np.loadtxt(fname, skiprows=1, usecols=range(5,12), delimiter=',').T
-        # now data is 2D array
-        return data
+        return openWeather(self.burn.name, self.date)
 
     def loadStartingPerim(self):
-        fname = 'data/{}/perims/{}.tif'.format(self.burn.name, self.date)
-        perim = cv2.imread(fname, cv2.IMREAD_UNCHANGED)
-        if perim is None:
-            raise RuntimeError('Could not find a perimeter for the fire {} for the day {}'.format(self.burn.name, self.date))
-        perim[perim!=0] = 255
-        return perim
+        return openStartingPerim(self.burn.name, self.date)
 
     def loadEndingPerim(self):
-        guess1, guess2 = possibleNextDates(self.date)
-        fname = 'data/{}/perims/{}.tif'.format(self.burn.name, guess1)
-        perim = cv2.imread(fname, cv2.IMREAD_UNCHANGED)
-        if perim is None:
-            # overflowed the month, that file didnt exist
-            fname = 'data/{}/perims/{}.tif'.format(self.burn.name, guess2)
-            perim = cv2.imread(fname, cv2.IMREAD_UNCHANGED)
-            if perim is None:
-                raise RuntimeError('Could not open a perimeter for the fire {} for the day {} or {}'.format(self.burn.name, guess1, guess2))
-        return perim
+        return openEndingPerim(self.burn.name, self.date)
 
     def __repr__(self):
         return "Day({},{})".format(self.burn.name, self.date)
@@ -0,0 +1,81 @@
+# selection.py
+'''Choosing which pixels of a day to use, based on how far they are from the
+fire perimeter at the start of the day.
+
+Every pixel's distance from the perimeter comes from one Euclidean distance
+transform of the day, no matter how far out we look. The distances and the
+masks of pixels within some band of distances are cached, so selecting the
+same band of the same day again is free. The caches are bounded by how
+many bytes they hold, not by how many days, forgetting the least recently
+used first. A distance map is 4 bytes a pixel, so the default budget keeps
+the distances of a few hundred 1000x1000 days, which is enough for a pass
+over the whole archive (eg Dataset.vulnerablePixels) to cost nothing the
+second time. With less memory to spare, lower the budgets: a pass over more
+days than fit recomputes every one of them each time.
+The cached masks are read-only, copy them before changing them.'''
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+
+from lib import rawdata
+
+# how many bytes of distances, and of masks, to keep around
+MAX_DISTANCE_BYTES = 2**30
+MAX_RING_BYTES = 2**28
+
+_distances = OrderedDict()
+_rings = OrderedDict()
+
+def distanceFromPerim(perim, pixelSize=rawdata.PIXEL_SIZE):
+    '''Return the distance in meters from each pixel to the nearest pixel of
+    the perimeter, which is 0 on the perimeter itself. If there isn't any
+    perimeter, then everything is infinitely far away.'''
+    burning = np.asarray(perim) != 0
+    if not burning.any():
+        return np.full(burning.shape, np.inf, dtype=np.float32)
+    # cv2 finds the distance to the nearest zero pixel
+    notBurning = (~burning).astype(np.uint8)
+    dist = cv2.distanceTransform(notBurning, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    dist *= pixelSize
+    return dist
+
+def ringMask(distances, minRadius, maxRadius):
+    '''The pixels that are further than minRadius, and at most maxRadius, from the perimeter'''
+    if minRadius > maxRadius:
+        raise ValueError("minRadius {} is bigger than maxRadius {}".format(minRadius, maxRadius))
+    return ((distances > minRadius) & (distances <= maxRadius)).astype(np.uint8)
+
+def dayDistances(day):
+    '''distanceFromPerim() of the starting perimeter of a Day, cached'''
+    key = (day.burn.name, day.date)
+    if key not in _distances:
+        dist = distanceFromPerim(day.startingPerim)
+        dist.flags.writeable = False
+        _remember(_distances, key, dist, MAX_DISTANCE_BYTES)
+    _distances.move_to_end(key)
+    return _distances[key]
+
+def dayRing(day, minRadius, maxRadius):
+    '''ringMask() of a Day, cached'''
+    key = (day.burn.name, day.date, minRadius, maxRadius)
+    if key not in _rings:
+        mask = ringMask(dayDistances(day), minRadius, maxRadius)
+        mask.flags.writeable = False
+        _remember(_rings, key, mask, MAX_RING_BYTES)
+    _rings.move_to_end(key)
+    return _rings[key]
+
+def _remember(cache, key, value, maxBytes):
+    '''Add an array to an OrderedDict, forgetting the least recently used
+    entries until they all fit in maxBytes (but always keeping the new one)'''
+    cache[key] = value
+    total = sum(arr.nbytes for arr in cache.values())
+    while total > maxBytes and len(cache) > 1:
+        oldKey, old = cache.popitem(last=False)
+        total -= old.nbytes
+
+def clear():
+    '''Forget all the cached distances and masks'''
+    _distances.clear()
+    _rings.clear()
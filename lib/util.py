@@ -1,6 +1,7 @@
 import os
 from time import localtime, strftime
 import csv
+import struct
 
 import numpy as np
 import cv2
@@ -15,6 +16,9 @@ try:
 except:
     pass
 
+# any pixel with an absolute value larger than this is considered NoData
+HUGE = 1e10
+
 def openImg(fname):
     if not os.path.exists(fname):
         raise ValueError("The file {} does not exist.".format(fname))
@@ -35,27 +39,93 @@ def openImg(fname):
     return cv2.merge(channels)
 
 def saveImg(fname, img):
+    '''Save a float32 TIFF, with nan pixels stored as the largest float32,
+    which openImg reads back as NoData'''
     to_save = np.array(img.astype('float32'))
-    print('datatype of saveimg is ', to_save.dtype)
     max_float = np.finfo(np.float32).max
-    print("to save shape is", to_save.shape)
-    print('max is ', max_float)
     to_save[np.where(np.isnan(to_save))] = max_float
-    # for listed in to_save:
-    #     for e in listed:
-    #         if np.isnan(e):
-    #             print('e is ', e)
-    #             listed[e] = max_float
-    print('after conversions', to_save)
-    if 'landsat' in fname:
-        print('landsat to_save shape is ', to_save.shape)
-        # np.savetxt('landsatrightafter32bitconversion.csv', to_save[:,:,0], delimiter=',')
     # imsave(fname, to_save.astype(np.uint8))
     tiff = TIFF.open(fname, mode='w')
     tiff.write_image(to_save)
     tiff.close()
     # cv2.imwrite(fname, to_save.astype(np.uint16))
 
+# TIFF tags we need to figure out the shape and dtype of an image
+_TIFF_WIDTH = 256
+_TIFF_HEIGHT = 257
+_TIFF_BITS_PER_SAMPLE = 258
+_TIFF_SAMPLES_PER_PIXEL = 277
+_TIFF_SAMPLE_FORMAT = 339
+# SampleFormat value -> numpy kind
+_TIFF_KINDS = {1:'uint', 2:'int', 3:'float'}
+# TIFF field type -> (struct code, size in bytes)
+_TIFF_TYPES = {1:('B',1), 3:('H',2), 4:('I',4), 16:('Q',8)}
+
+def tiffInfo(fname):
+    '''Read just the header of a TIFF file, without decoding any pixels.
+
+    Returns (shape, dtype), or None if the file is not a readable TIFF.'''
+    try:
+        with open(fname, 'rb') as f:
+            header = f.read(16)
+            order = {b'II':'<', b'MM':'>'}.get(header[:2])
+            if order is None:
+                return None
+            magic, = struct.unpack(order+'H', header[2:4])
+            if magic == 42:
+                # classic TIFF
+                ifdOffset, = struct.unpack(order+'I', header[4:8])
+                countFmt, entryFmt, valueSize = 'H', 'HHI', 4
+            elif magic == 43:
+                # BigTIFF
+                ifdOffset, = struct.unpack(order+'Q', header[8:16])
+                countFmt, entryFmt, valueSize = 'Q', 'HHQ', 8
+            else:
+                return None
+            f.seek(ifdOffset)
+            countSize = struct.calcsize(countFmt)
+            nentries, = struct.unpack(order+countFmt, f.read(countSize))
+            entrySize = struct.calcsize(order+entryFmt) + valueSize
+            entries = f.read(nentries * entrySize)
+            if len(entries) != nentries * entrySize:
+                return None
+            tags = {}
+            for i in range(nentries):
+                entry = entries[i*entrySize:(i+1)*entrySize]
+                tag, typ, count = struct.unpack(order+entryFmt, entry[:-valueSize])
+                if typ not in _TIFF_TYPES:
+                    continue
+                code, size = _TIFF_TYPES[typ]
+                if size * count <= valueSize:
+                    # the (first) value is stored right in the entry
+                    value, = struct.unpack(order+code, entry[-valueSize:][:size])
+                else:
+                    # the values are stored elsewhere, we only need the first
+                    offsetCode = 'I' if valueSize == 4 else 'Q'
+                    offset, = struct.unpack(order+offsetCode, entry[-valueSize:])
+                    here = f.tell()
+                    f.seek(offset)
+                    value, = struct.unpack(order+code, f.read(size))
+                    f.seek(here)
+                tags[tag] = value
+    except (OSError, struct.error):
+        return None
+
+    if _TIFF_WIDTH not in tags or _TIFF_HEIGHT not in tags:
+        return None
+    bits = tags.get(_TIFF_BITS_PER_SAMPLE, 1)
+    kind = _TIFF_KINDS.get(tags.get(_TIFF_SAMPLE_FORMAT, 1), 'uint')
+    try:
+        dtype = np.dtype('{}{}'.format(kind, bits)).name
+    except TypeError:
+        # eg 1 bit images, which cv2 opens as uint8
+        dtype = 'uint8'
+    shape = [tags[_TIFF_HEIGHT], tags[_TIFF_WIDTH]]
+    samples = tags.get(_TIFF_SAMPLES_PER_PIXEL, 1)
+    if samples > 1:
+        shape.append(samples)
+    return shape, dtype
+
 def listdir_nohidden(path):
     '''List all the files in a path that are not hidden (begin with a .)'''
     result = []
@@ -74,7 +144,6 @@ def invalidPixelIndices(layer):
 
 def invalidPixelMask(layer):
     # If there are any massively valued pixels, just return those
-    HUGE = 1e10
     huge = np.absolute(layer) > HUGE
     if np.any(huge):
         return huge
@@ -115,9 +184,8 @@ def partition(things, ratios=None):
     if ratios is None:
         ratios = [.5]
     beginIndex = 0
-    ratios.append(1)
     partitions = []
-    for r in ratios:
+    for r in list(ratios) + [1]:
         endIndex = int(round(r * len(things)))
         # print(beginIndex, endIndex)
         section = things[beginIndex:endIndex]
@@ -128,35 +196,42 @@ def partition(things, ratios=None):
 
 
 def savePredictions(predictions, fname=None):
+    '''Save (PointIndex, predictions), as returned by FireModel.predict, to a csv'''
+    from lib import dataset
     directory = 'output/predictions/'
     if fname is None:
         timeString = strftime("%d%b%H:%M", localtime())
         fname = directory + '{}.csv'.format(timeString)
     if not fname.startswith(directory):
         fname = directory + fname
+    if isinstance(predictions, dict):
+        predictions = dataset.PointIndex.fromDict(predictions)
+    index, preds = predictions
     with open(fname, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile, delimiter=',')
-        for pt, pred in predictions.items():
-            burnName, date, location = pt
-            y,x = location
-            row = [str(burnName), str(date), str(y), str(x), str(pred)]
-            writer.writerow(row)
+        for (burnName, date), indices in index.days():
+            ys, xs = index.ys[indices].tolist(), index.xs[indices].tolist()
+            for y, x, pred in zip(ys, xs, preds[indices].tolist()):
+                writer.writerow([burnName, date, str(y), str(x), str(pred)])
 
 def openPredictions(fname):
-    result = {}
+    '''Returns (PointIndex, predictions)'''
+    from lib import dataset
+    burnNames, dates, ys, xs, preds = [], [], [], [], []
     with open(fname, 'r') as csvfile:
         reader = csv.reader(csvfile, delimiter=',')
         for row in reader:
             burnName, date, y, x, pred = row
+            burnNames.append(burnName)
             # ensure the date is 4 chars long
-            date = str(date).zfill(4)
-            x = int(x)
-            y = int(y)
-            pred = float(pred)
-            p = dataset.Point(burnName, date, (y,x))
-            result[p] = pred
-    return result
-
+            dates.append(str(date).zfill(4))
+            ys.append(int(y))
+            xs.append(int(x))
+            preds.append(float(pred))
+    burnTable, burnIds = np.unique(np.array(burnNames, dtype=object).astype(str), return_inverse=True)
+    dateTable, dateIds = np.unique(np.array(dates, dtype=object).astype(str), return_inverse=True)
+    index = dataset.PointIndex(burnTable.tolist(), dateTable.tolist(), burnIds, dateIds, ys, xs)
+    return index, np.array(preds, dtype=np.float32)
 
 if __name__ == '__main__':
     import glob
@@ -27,32 +27,18 @@ def renderUsedPixels(dataset, burnName, date):
 
 
 def renderPredictions(dataset, predictions):
-    # print('predictions are', predictions.values())
-    day2pred = {}
-    for pt, pred in predictions.items():
-        burnName, date, location = pt
-        day = (burnName, date)
-        if day not in day2pred:
-            day2pred[day] = []
-        pair = (location, float(pred))
-        # print('storing prediction', pair)
-        day2pred[day].append(pair)
-
-    # print('these are all the original days:', day2pred.keys())
+    '''predictions is (PointIndex, predictions), as returned by FireModel.predict.
+    Returns {(burnName, date): canvas} where each predicted pixel is 1+prediction'''
+    if isinstance(predictions, dict):
+        from lib.dataset import PointIndex
+        predictions = PointIndex.fromDict(predictions)
+    index, preds = predictions
+    preds = np.asarray(preds, dtype=np.float32).ravel()
     results = {}
-    for (burnName, date), locsAndPreds in day2pred.items():
-        # print('locs and preds', locsAndPreds)
-        locs, preds = zip(*locsAndPreds)
-        # print('reds:', preds)
-        xs,ys = zip(*locs)
-        preds = [pred+1 for pred in preds]
-        # print((xs,ys))
-        # print(max(preds), min(preds))
-        # print(len(xs), len(preds))
+    for (burnName, date), indices in index.days():
         burn = dataset.data.burns[burnName]
         canvas = np.zeros(burn.layerSize, dtype=np.float32)
-        # print(canvas)
-        canvas[(xs,ys)] = np.array(preds, dtype=np.float32)
+        canvas[index.ys[indices], index.xs[indices]] = preds[indices] + 1
         results[(burnName, date)] = canvas
     return results
 
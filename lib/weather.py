@@ -0,0 +1,151 @@
+# weather.py
+'''A cache of the hourly weather tables of every burn.
+
+The weather of a day lives in data/<burn>/weather/<date>.csv, one row per
+hour. Parsing those with np.loadtxt is slow, and the same files get parsed
+over and over. Instead, each CSV is parsed once, all of its columns in one
+pass, and all the days of a burn are kept together in a binary archive at
+data/_cache/weather/<burn>.npz, along with the size and mtime of the CSV
+each day came from. A day is only parsed again if its CSV changes.
+
+The columns of a table are the month, date, hour(ish) columns 0-4, then
+columns 5-11 are the actual weather: temp, dewpt, temp2, wdir, wspeed,
+precip, hum. See weatherMatrix().
+
+Loading many days at once should refresh() each burn first, so that
+table() only ever reads the cache and the archive is written once per burn
+instead of once per new day. Everything here is also guarded by a lock, so
+threads can share the cache.'''
+import os
+import json
+import threading
+
+import numpy as np
+
+from lib import util
+
+CACHE_DIR = 'data/_cache/weather/'
+VERSION = 1
+# the columns of a table that make up the weather matrix
+WEATHER_COLUMNS = slice(5, 12)
+# the column of the wind direction, in degrees
+WIND_DIRECTION = 8
+
+_memoed = {}
+_lock = threading.RLock()
+
+def table(burnName, date):
+    '''Return the whole (nhours, ncolumns) table of a day, read-only'''
+    fname = _csvName(burnName, date)
+    if not os.path.exists(fname):
+        raise ValueError("The file {} does not exist.".format(fname))
+    fp = _fingerprint(fname)
+    with _lock:
+        tables, fingerprints = _tables(burnName)
+        if fingerprints.get(date) != fp:
+            # new or changed since we last looked
+            tables[date] = _readOnly(parse(fname))
+            fingerprints[date] = fp
+            _write(burnName, tables, fingerprints)
+        return tables[date]
+
+def weatherMatrix(burnName, date):
+    '''The (7, nhours) weather matrix of a day, which is the transpose of
+    columns 5-11 of its table'''
+    return table(burnName, date)[:, WEATHER_COLUMNS].T
+
+def refresh(burnName):
+    '''Bring the cache of a burn up to date with every CSV on disk, and
+    return {date: table}'''
+    directory = 'data/{}/weather/'.format(burnName)
+    fnames = util.listdir_nohidden(directory) if os.path.isdir(directory) else []
+    with _lock:
+        tables, fingerprints = _tables(burnName)
+        changed = False
+        for fname in fnames:
+            date, ext = os.path.splitext(fname)
+            if ext != '.csv':
+                continue
+            fp = _fingerprint(directory+fname)
+            if fingerprints.get(date) != fp:
+                tables[date] = _readOnly(parse(directory+fname))
+                fingerprints[date] = fp
+                changed = True
+        if changed:
+            _write(burnName, tables, fingerprints)
+        return dict(tables)
+
+def parse(fname):
+    '''Parse a weather CSV into a float array, with one row per line after the header'''
+    with open(fname, 'r') as f:
+        header = f.readline()
+        text = f.read()
+    ncolumns = len(header.split(','))
+    lines = [line for line in text.splitlines() if line.strip()]
+    for i, line in enumerate(lines):
+        if line.count(',') != ncolumns-1:
+            raise ValueError("Row {} of {} has {} columns, not {} like the header".format(i+1, fname, line.count(',')+1, ncolumns))
+    if not lines:
+        return np.empty((0, ncolumns))
+    # splitting everything at once and letting numpy convert the strings
+    # is much faster than np.loadtxt going line by line
+    fields = ','.join(lines).split(',')
+    try:
+        return np.array(fields, dtype=np.float64).reshape(-1, ncolumns)
+    except ValueError:
+        # there are empty fields, let the slow parser make them nan
+        return np.genfromtxt(fname, delimiter=',', skip_header=1, dtype=np.float64).reshape(-1, ncolumns)
+
+def clear(burnName=None):
+    '''Forget the cache of one burn, or every burn'''
+    with _lock:
+        names = [burnName] if burnName is not None else list(_memoed)
+        for name in names:
+            _memoed.pop(name, None)
+            if os.path.exists(_cacheName(name)):
+                os.remove(_cacheName(name))
+
+def _tables(burnName):
+    '''The memoed ({date: table}, {date: fingerprint}) of a burn, read from the cache file if needed'''
+    if burnName not in _memoed:
+        _memoed[burnName] = _read(burnName)
+    return _memoed[burnName]
+
+def _csvName(burnName, date):
+    return 'data/{}/weather/{}.csv'.format(burnName, date)
+
+def _cacheName(burnName):
+    return CACHE_DIR + burnName + '.npz'
+
+def _fingerprint(fname):
+    stat = os.stat(fname)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _readOnly(arr):
+    arr.flags.writeable = False
+    return arr
+
+def _read(burnName):
+    fname = _cacheName(burnName)
+    if not os.path.exists(fname):
+        return {}, {}
+    try:
+        with np.load(fname) as archive:
+            info = json.loads(str(archive['_info']))
+            if info.get('version') != VERSION:
+                return {}, {}
+            tables = {date:_readOnly(archive['d'+date]) for date in info['fingerprints']}
+    except Exception:
+        # corrupted somehow (truncated, bad CRC, not a zip at all...), just rebuild it
+        return {}, {}
+    return tables, info['fingerprints']
+
+def _write(burnName, tables, fingerprints):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fname = _cacheName(burnName)
+    # unique per thread as well as per process, so writers never share a temp file
+    tmp = '{}.{}.{}.tmp.npz'.format(fname[:-len('.npz')], os.getpid(), threading.get_ident())
+    info = json.dumps({'version':VERSION, 'fingerprints':fingerprints})
+    arrays = {'d'+date:arr for date, arr in list(tables.items())}
+    np.savez(tmp, _info=np.array(info), **arrays)
+    os.replace(tmp, fname)
@@ -7,15 +7,15 @@ from lib import viz
 from lib import preprocess
 from lib import util
 
+AOI_RADIUS = 30
+
 def openDatasets():
     data = rawdata.load()
     masterDataSet = dataset.Dataset(data, dataset.Dataset.vulnerablePixels)
-    ptList = masterDataSet.sample(sampleEvenly=False)
-    # masterDataSet.points = dataset.Dataset.toDict(ptList)
-    trainPts, validatePts, testPts =  util.partition(ptList, ratios=[.6,.7])
-    train = dataset.Dataset(data, trainPts)
-    validate = dataset.Dataset(data, validatePts)
-    test = dataset.Dataset(data, testPts)
+    sampled = masterDataSet.sample(sampleEvenly=False)
+    # keep overlapping AOIs from ending up in both training and testing.
+    # Blocks are much bigger than the guard band, so few points get dropped
+    train, validate, test = sampled.split([.6,.7], method='block', blockSize=256, guard=AOI_RADIUS)
     return train, validate, test
 
 def openAndTrain():
@@ -23,11 +23,11 @@ def openAndTrain():
 
     # data = rawdata.RawData.load(burnNames='all', dates='all')
     # masterDataSet = dataset.Dataset(data, dataset.Dataset.vulnerablePixels)
-    # masterDataSet.points = masterDataSet.evenOutPositiveAndNegative()
+    # masterDataSet = masterDataSet.evenOutPositiveAndNegative()
     train, validate, test = openDatasets()
-    train.save('train')
-    test.save('test')
-    validate.save('validate')
+    train.saveIndex('train')
+    test.saveIndex('test')
+    validate.saveIndex('validate')
     # print(train, validate, test)
     mod = getModel()
     mod.fit(train, validate)
@@ -46,8 +46,7 @@ def getModel(weightsFile=None):
     from lib import model
     numWeatherInputs = 8
     usedLayers = ['dem','ndvi', 'aspect', 'band_2', 'band_3', 'band_4', 'band_5'] #, 'slope'
-    AOIRadius = 30
-    pp = preprocess.PreProcessor(numWeatherInputs, usedLayers, AOIRadius)
+    pp = preprocess.PreProcessor(numWeatherInputs, usedLayers, AOI_RADIUS)
 
     mod = model.FireModel(pp, weightsFile)
     return mod
@@ -1,8 +1,38 @@
 #test.py
 import unittest
+import os
+import tempfile
+
+from unittest import mock
+
+import numpy as np
 
 from lib import rawdata
 from lib import dataset
+from lib import preprocess
+from lib import selection
+from lib import normalization
+from lib import weather
+from lib import augmentation
+from lib import image
+
+def syntheticData(burnNames=('burnA', 'burnB'), dates=('0731', '0801'), shape=(30, 30), seed=0):
+    '''A small RawData made up in memory, of round fires that grow every day'''
+    rng = np.random.RandomState(seed)
+    h, w = shape
+    ys, xs = np.mgrid[:h, :w]
+    dist = np.hypot(ys - h/2, xs - w/2)
+    burns = {}
+    for burnName in burnNames:
+        layers = {name:(rng.rand(h, w)*1000).astype(np.float32) for name in rawdata.Burn.layerFileNames(burnName)}
+        burn = rawdata.Burn(burnName, layers=layers)
+        for i, date in enumerate(dates):
+            start = (dist < 4+3*i).astype(np.uint8) * 255
+            end = (dist < 6+3*i + rng.rand(h, w)*6).astype(np.uint8)
+            weather = rng.rand(7, 24) * [[40], [20], [40], [360], [15], [2], [100]]
+            burn.days[date] = rawdata.Day(burn, date, weather, start, end)
+        burns[burnName] = burn
+    return rawdata.RawData(burns)
 
 class TestRawdata(unittest.TestCase):
 
@@ -37,5 +67,469 @@ class TestDataset(unittest.TestCase):
         # print(reloaded)
         # print(self.ds)
 
+    def test_dayMasksCopyOnWrite(self):
+        arr = np.ones((4, 5), dtype=np.uint8)
+        masks = dataset.DayMasks({'0731':arr})
+        # changing the caller's array doesn't change us
+        arr[:] = 0
+        self.assertEqual(masks.total(), 20)
+        # and changing our mask doesn't change anything we shared it with
+        writable = masks.writable('0731')
+        shared = masks.share()
+        writable[:] = 0
+        self.assertEqual(shared.total(), 20)
+        self.assertEqual(masks.total(), 0)
+        with self.assertRaises(ValueError):
+            shared['0731'][0, 0] = 0
+
+    def test_sample(self):
+        ds = dataset.Dataset(syntheticData(), dataset.Dataset.vulnerablePixels)
+        for sampleEvenly in (True, False):
+            sampled = ds.sample(sampleEvenly=sampleEvenly, seed=1)
+            burned, notBurned = sampled.countBurnedAndNot()
+            self.assertEqual(burned, notBurned)
+            # only points we had to begin with
+            for burnName, date in sampled.getUsedBurnNamesAndDates():
+                chosen = sampled.points[burnName][date] != 0
+                self.assertFalse((chosen & (ds.points[burnName][date] == 0)).any())
+            # the same seed gives the same points
+            self.assertEqual(ds.sample(sampleEvenly=sampleEvenly, seed=1), sampled)
+            self.assertNotEqual(ds.sample(sampleEvenly=sampleEvenly, seed=2), sampled)
+        evenly = ds.sample(sampleEvenly=True, seed=1)
+        counts = [evenly.countDay(b, d) for b, d in evenly.getUsedBurnNamesAndDates()]
+        self.assertEqual(len(set(counts)), 1)
+        # without sampling evenly, every day gives all it can
+        unevenly = ds.sample(sampleEvenly=False, seed=1)
+        for burnName, date in ds.getUsedBurnNamesAndDates():
+            endingPerim = ds.data.getDay(burnName, date).endingPerim
+            didBurn = ds.points[burnName][date].astype(bool) & (endingPerim == 1)
+            limit = min(didBurn.sum(), ds.countDay(burnName, date) - didBurn.sum())
+            self.assertEqual(unevenly.countDay(burnName, date), 2*limit)
+        # aiming for a number of samples
+        some = ds.sample(goalNumber=20, sampleEvenly=False, seed=1)
+        self.assertEqual(some.countBurnedAndNot(), (10, 10))
+        with self.assertRaises(ValueError):
+            ds.sample(goalNumber=2*len(ds), sampleEvenly=False)
+
+    def test_evenOutPositiveAndNegative(self):
+        ds = dataset.Dataset(syntheticData(), dataset.Dataset.vulnerablePixels)
+        burned, notBurned = ds.countBurnedAndNot()
+        evened = ds.evenOutPositiveAndNegative(seed=0)
+        self.assertEqual(evened.countBurnedAndNot(), (min(burned, notBurned),)*2)
+        self.assertEqual(ds.evenOutPositiveAndNegative(seed=0), evened)
+
+    def test_splitGuard(self):
+        from scipy import ndimage
+        data = syntheticData(shape=(64, 64))
+        ds = dataset.Dataset(data, 'all')
+        r = 5
+        train, validate, test = ds.split([.6, .7], method='block', blockSize=16, guard=r, seed=0)
+        self.assertTrue(len(train) and len(validate) and len(test))
+        for burnName in data.burns:
+            def near(*parts):
+                # every pixel within r of a point of the parts, on any day
+                used = np.zeros(data.burns[burnName].layerSize, dtype=bool)
+                for part in parts:
+                    for mask in part.points.get(burnName, {}).values():
+                        used |= mask != 0
+                return ndimage.maximum_filter(used, size=2*r+1)
+            for part, others in [(test, (train, validate)), (validate, (train, test))]:
+                nearOthers = near(*others)
+                for mask in part.points.get(burnName, {}).values():
+                    self.assertFalse(nearOthers[mask != 0].any())
+        with self.assertRaises(ValueError):
+            ds.split([.5], method='day', guard=r)
+
+    def test_counts(self):
+        data = syntheticData()
+        ds = dataset.Dataset(data, dataset.Dataset.vulnerablePixels)
+        def countAll(ds):
+            burned = notBurned = 0
+            for burnName, date in ds.getUsedBurnNamesAndDates():
+                used = ds.points[burnName][date] != 0
+                didBurn = data.getDay(burnName, date).endingPerim == 1
+                self.assertEqual(ds.countDay(burnName, date), used.sum())
+                burned += (used & didBurn).sum()
+                notBurned += (used & ~didBurn).sum()
+            self.assertEqual(ds.countBurnedAndNot(), (burned, notBurned))
+            self.assertEqual(len(ds), burned + notBurned)
+        countAll(ds)
+        # changing a mask changes the counts
+        view = ds.view()
+        view.writableMask('burnA', '0731')[:10] = 0
+        view.points['burnB']['0801'] = np.ones((30, 30), dtype=np.uint8)
+        countAll(view)
+        countAll(ds)
+        # a saved dataset is counted from its coordinates, without building its masks
+        with tempfile.TemporaryDirectory() as directory:
+            dataset.saveSparse(view.points, directory + '/')
+            reloaded = dataset.Dataset(data, dataset.openSparse(directory + '/'))
+            self.assertEqual(len(reloaded), len(view))
+            self.assertEqual(reloaded.countDay('burnA', '0731'), view.countDay('burnA', '0731'))
+            self.assertIn('0731', reloaded.points['burnA']._pending)
+
+class TestPointIndex(unittest.TestCase):
+
+    def test_masksRoundTrip(self):
+        masks = {'burnA': {'0711': np.eye(4, dtype=np.uint8), '0712': np.zeros((4,4), dtype=np.uint8)},
+                 'burnB': {'0711': np.ones((2,3), dtype=np.uint8)}}
+        index = dataset.PointIndex.fromMasks(masks)
+        self.assertEqual(len(index), 4+6)
+        self.assertEqual(index[0], dataset.Point('burnA', '0711', (0,0)))
+        self.assertEqual(dataset.PointIndex.fromPoints(index.toList()), index)
+        shapes = lambda burnName, date: masks[burnName][date].shape
+        back = index.toMasks(shapes)
+        np.testing.assert_array_equal(back['burnA']['0711'], masks['burnA']['0711'])
+        np.testing.assert_array_equal(back['burnB']['0711'], masks['burnB']['0711'])
+        # days without any points don't show up
+        self.assertNotIn('0712', back['burnA'])
+
+    def test_saveLoad(self):
+        index = dataset.PointIndex(['burnA', 'burnB'], ['0711', '0712'], [0, 1, 1], [1, 0, 1], [5, 300, 7], [0, 2, 70000])
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, 'index.npz')
+            index.save(fname)
+            self.assertEqual(dataset.PointIndex.load(fname), index)
+
+class TestPreprocess(unittest.TestCase):
+
+    def test_extractMany(self):
+        r = 3
+        padded = np.random.rand(20+2*r, 15+2*r, 4).astype(np.float32)
+        ys = np.array([0, 19, 5, 5])
+        xs = np.array([0, 14, 7, 7])
+        expected = np.array([preprocess.extract(padded, loc, r) for loc in zip(ys, xs)])
+        np.testing.assert_array_equal(preprocess.extractMany(padded, ys, xs, r), expected)
+        with self.assertRaises(ValueError):
+            preprocess.extractMany(padded, [20], [0], r)
+
+    def test_normalizeLayers(self):
+        layers = {'dem':{'a':np.array([[10., 20.], [np.nan, 30.]]), 'b':np.array([[0., 40.]])},
+                  'ndvi':{'a':np.array([[-1., 1.]]), 'b':np.array([[0., 3.]])}}
+        normed = preprocess.normalizeLayers(layers)
+        # elevations are relative to each burn, scaled by the biggest range
+        np.testing.assert_allclose(normed['dem']['a'], [[0, .25], [0, .5]])
+        np.testing.assert_allclose(normed['dem']['b'], [[0, 1]])
+        np.testing.assert_allclose(normed['ndvi']['a'], [[0, .5]])
+        np.testing.assert_allclose(normed['ndvi']['b'], [[.25, 1]])
+
+    def test_weatherFeatures(self):
+        rng = np.random.RandomState(0)
+        # days with different numbers of hours, and winds right on the compass points
+        matrices = [rng.rand(7, n) * [[40], [20], [40], [360], [15], [2], [100]] for n in (24, 23, 1)]
+        matrices[0][3, :4] = [0, 90, 180, 270]
+        features = preprocess.weatherFeatures(matrices)
+        for wm, row in zip(matrices, features):
+            temp, dewpt, temp2, wdir, wspeed, precip, hum = wm
+            # the wind components, hour by hour
+            n = s = e = w = 0
+            for d, speed in zip(wdir, wspeed):
+                ns, ew = abs(np.cos(np.radians(d)) * speed), abs(np.sin(np.radians(d)) * speed)
+                n += ns if (d < 90 or d > 270) else 0
+                s += ns if 90 < d < 270 else 0
+                e += ew if 0 < d < 180 else 0
+                w += ew if 180 < d < 360 else 0
+            expected = [preprocess.totalPrecipitation(wm), preprocess.maximumTemperature1(wm),
+                        preprocess.maximumTemperature2(wm), preprocess.averageHumidity(wm), n, s, e, w]
+            np.testing.assert_allclose(row, expected, rtol=1e-10, atol=1e-10)
+            np.testing.assert_allclose(preprocess.windMetrics(wm), [n, s, e, w], rtol=1e-10, atol=1e-10)
+
+    def test_augmentSamples(self):
+        # the north edge of the AOI is lit, and all the wind comes from the north
+        n = len(preprocess.TRANSFORMS)
+        imgs = np.zeros((n, 5, 5, 2), dtype=np.float32)
+        imgs[:, 0, :, 0] = 1
+        imgs[:, 0, 0, 0] = 2
+        weather = np.zeros((n, 8), dtype=np.float32)
+        weather[:, preprocess.WEATHER_METRICS.index('n')] = 1
+        # the slopes face north too, except one flat pixel. Aspects run from -1 (flat) to 359
+        offset, scale = -1., 1/360.
+        imgs[:, :, :, 1] = (0 - offset) * scale
+        imgs[:, 2, 2, 1] = 0
+        turned, turnedWeather = preprocess.augmentSamples(imgs, weather, np.arange(n), (1, offset, scale))
+        edges = {'n':turned[:, 0, :, 0], 's':turned[:, -1, :, 0], 'e':turned[:, :, -1, 0], 'w':turned[:, :, 0, 0]}
+        for i in range(n):
+            # the wind still comes from the lit edge
+            windFrom = [m for m in 'nsew' if turnedWeather[i, preprocess.WEATHER_METRICS.index(m)] == 1]
+            self.assertEqual(len(windFrom), 1)
+            self.assertTrue((edges[windFrom[0]][i] > 0).all())
+            # and the slopes face it
+            aspects = turned[i, :, :, 1] / scale + offset
+            facing = {'n':0, 'e':90, 's':180, 'w':270}[windFrom[0]]
+            self.assertAlmostEqual(aspects[0, 0], facing, places=3)
+            self.assertEqual(turned[i, 2, 2, 1], 0)
+        # all 8 are different
+        self.assertEqual(len(set(t[..., 0].tobytes() for t in turned)), n)
+        np.testing.assert_array_equal(turned[0], imgs[0])
+
+    def test_augmentAspect(self):
+        data = syntheticData()
+        burn = data.burns['burnA']
+        aspect = np.full(burn.layerSize, 90, dtype=np.float32)
+        # the lowest aspect, which normalizes to 0 just like NoData does
+        aspect[15, 15] = 0
+        aspect[15, 16] = np.nan
+        burn.layers['aspect'] = aspect
+        ds = dataset.Dataset(data, {'burnA':{'0731':'all'}})
+        seq = preprocess.PreProcessor(8, ['aspect'], 3).flow(ds, batchSize=None, shuffle=False, augment=True)
+        points = seq.getPoints()
+        i = np.flatnonzero((points.ys == 15) & (points.xs == 15))
+        # a quarter turn counterclockwise
+        (weather, imgs), outputs = seq.getBatch(i, transforms=np.array([1]))
+        normalized = imgs[0, :, :, 1]
+        # the north facing center now faces west, and what faced east faces north
+        self.assertAlmostEqual(normalized[3, 3], 270/90, places=5)
+        self.assertAlmostEqual(normalized[3, 2], 0, places=5)
+        # the NoData pixel east of the center moved north, and stayed NoData
+        self.assertEqual(normalized[2, 3], 0)
+        np.testing.assert_allclose(np.delete(normalized.ravel(), [2*7+3, 3*7+3]), 0, atol=1e-5)
+
+class TestWeather(unittest.TestCase):
+
+    def setUp(self):
+        # the cache lives in data/, so work in a directory of our own
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        os.makedirs('data/burnA/weather/')
+        self.fname = 'data/burnA/weather/0731.csv'
+        weather.clear()
+
+    def tearDown(self):
+        weather.clear()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def write(self, rows, mtime):
+        with open(self.fname, 'w') as fp:
+            fp.write('a,b,c\n' + ''.join(row + '\n' for row in rows))
+        os.utime(self.fname, ns=(mtime, mtime))
+
+    def test_parse(self):
+        self.write(['1,2,3', '4, 5 ,6e1'], 0)
+        np.testing.assert_array_equal(weather.parse(self.fname), [[1, 2, 3], [4, 5, 60]])
+        # empty fields become nan
+        self.write(['1,,3', '4,5,6'], 0)
+        np.testing.assert_array_equal(weather.parse(self.fname), [[1, np.nan, 3], [4, 5, 6]])
+        # a short row and a long row have the right number of fields between them,
+        # but they can't be lined up with the header
+        self.write(['1,2', '3,4,5,6'], 0)
+        with self.assertRaises(ValueError):
+            weather.parse(self.fname)
+
+    def test_cache(self):
+        self.write(['1,2,3'], 10**9)
+        with mock.patch.object(weather, 'parse', wraps=weather.parse) as parse:
+            first = weather.table('burnA', '0731')
+            np.testing.assert_array_equal(first, [[1, 2, 3]])
+            # a hit doesn't parse again, even in a fresh process reading the archive
+            self.assertIs(weather.table('burnA', '0731'), first)
+            weather._memoed.clear()
+            np.testing.assert_array_equal(weather.table('burnA', '0731'), first)
+            self.assertEqual(parse.call_count, 1)
+            # the same size but a new mtime is parsed again
+            self.write(['4,5,6'], 2*10**9)
+            np.testing.assert_array_equal(weather.table('burnA', '0731'), [[4, 5, 6]])
+            self.assertEqual(parse.call_count, 2)
+            weather._memoed.clear()
+            np.testing.assert_array_equal(weather.table('burnA', '0731'), [[4, 5, 6]])
+            self.assertEqual(parse.call_count, 2)
+
+class TestAugmentation(unittest.TestCase):
+
+    def test_turnAspect(self):
+        aspect = np.array([0, 90, 350, -1, np.nan, -3.4e38], dtype=np.float32)
+        np.testing.assert_array_equal(augmentation.turnAspect(aspect, 30), np.array([30, 120, 20, -1, np.nan, -3.4e38], dtype=np.float32))
+        # rotate() turns what was north of the center to the east, so a
+        # slope that faced north faces east, like the wind from the north comes from the east
+        stack = np.zeros((21, 21, 1), dtype=np.float32)
+        stack[2, 10] = 1
+        ys, xs = np.nonzero(augmentation.rotate(stack, 90)[:, :, 0])
+        self.assertTrue(xs[0] > 15 and abs(ys[0]-10) <= 1)
+        self.assertEqual(augmentation.turnAspect(np.zeros(1), 90)[0], 90)
+
+    def test_saveRotatedWeather(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                os.chdir(directory)
+                os.makedirs('data/burnA/weather/')
+                rng = np.random.RandomState(0)
+                original = rng.rand(24, 12) * 360
+                np.savetxt('data/burnA/weather/0731.csv', original, delimiter=',', fmt='%.17g',
+                        header=','.join('c{}'.format(i) for i in range(12)), comments='')
+                augmentation.saveRotatedWeather('burnA', '0731', 12.345678901, 'rotated.csv')
+                expected = weather.table('burnA', '0731').copy()
+                expected[:, weather.WIND_DIRECTION] = (expected[:, weather.WIND_DIRECTION] + 12.345678901) % 360
+                np.testing.assert_array_equal(weather.parse('rotated.csv'), expected)
+            finally:
+                weather.clear()
+                os.chdir(cwd)
+
+    def test_sourceStats(self):
+        # a variant cut from a fire is normalized like the whole fire, not like the crop
+        layers = ['dem', 'ndvi']
+        whole = dataset.Dataset(syntheticData(('burnA',)), dataset.Dataset.vulnerablePixels)
+        expected = preprocess.fitNormalizer(whole, layers)
+        data = syntheticData(('burnA', 'burnA_v'))
+        source = data.burns['burnA']
+        variant = data.burns['burnA_v']
+        variant.layers = {name:layer[5:20, 8:25] for name, layer in source.layers.items()}
+        ds = dataset.Dataset(data, dataset.Dataset.vulnerablePixels)
+        cropped = preprocess.fitNormalizer(ds, layers)
+        self.assertNotEqual(cropped.scaleAndOffset('dem', 'burnA_v', None), expected.scaleAndOffset('dem', 'burnA', None))
+        variant.source = {'fire':'burnA', 'window':[5, 8],
+                'stats':{name:normalization.LayerStats().update(source.layers[name]).toDict() for name in layers}}
+        normalizer = preprocess.fitNormalizer(ds, layers)
+        for name in layers:
+            self.assertEqual(normalizer.scaleAndOffset(name, 'burnA_v', None), expected.scaleAndOffset(name, 'burnA', None))
+
+    def test_makeVariantSource(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                os.chdir(directory)
+                stats = {'dem':normalization.LayerStats().update(np.arange(10.0)).toDict()}
+                with mock.patch.object(augmentation, 'stackFire', return_value=(np.zeros((9, 9, 1), np.float32), ['0731'])), \
+                        mock.patch.object(augmentation, 'util'), mock.patch.object(augmentation, 'saveRotatedWeather'):
+                    entry = augmentation.makeVariant(('burnA', 0, ['0731'], 0, 7), 10, 'data/', window=(3, 4, 9, 9), stats=stats)
+                burn = rawdata.Burn(entry['name'], layers={'dem':np.zeros((9, 9))})
+                self.assertEqual(burn.source['window'], entry['window'])
+                self.assertEqual(burn.source['stats'], stats)
+            finally:
+                os.chdir(cwd)
+
+class TestImage(unittest.TestCase):
+
+    def test_applyTransform(self):
+        from scipy import ndimage
+        rng = np.random.RandomState(0)
+        theta = np.deg2rad(27)
+        matrix = np.array([[np.cos(theta), -np.sin(theta), 1.5],
+                           [np.sin(theta), np.cos(theta), -2.25],
+                           [0, 0, 1]])
+        for channelAxis in (0, 2):
+            shape = [17, 23]
+            shape.insert(channelAxis, 4)
+            x = rng.rand(*shape).astype(np.float32)
+            transform = image.transform_matrix_offset_center(matrix, 17, 23)
+            for mode in ('constant', 'nearest', 'reflect', 'wrap'):
+                # one channel at a time, like apply_transform used to
+                channels = [ndimage.affine_transform(channel, transform[:2, :2], transform[:2, 2], order=0, mode=mode, cval=.5)
+                            for channel in np.rollaxis(x, channelAxis, 0)]
+                expected = np.rollaxis(np.stack(channels, axis=0), 0, channelAxis+1)
+                result = image.apply_transform(x, transform, channel_axis=channelAxis, fill_mode=mode, cval=.5)
+                np.testing.assert_array_equal(result, expected)
+
+class TestNormalization(unittest.TestCase):
+
+    def test_percentiles(self):
+        # a small burn and a big one, whose samples get taken at different strides
+        layers = {'ndvi':{'small':np.zeros((1000, 300)), 'big':np.ones((1000, 1000))}}
+        normalizer = normalization.Normalizer(keepSamples=True).fit(layers)
+        stats = normalizer.stats['ndvi']
+        # every pixel counts the same, no matter which burn it was in
+        self.assertAlmostEqual(np.concatenate(stats.samples).mean(), 1000/1300, places=2)
+        self.assertEqual(stats.percentile(20), 0)
+        self.assertEqual(stats.percentile(30), 1)
+        # a reloaded normalizer still knows its percentiles
+        reloaded = normalization.Normalizer.fromDict(normalizer.toDict())
+        for q in (10, 20, 30, 90):
+            self.assertEqual(reloaded.stats['ndvi'].percentile(q), stats.percentile(q))
+            self.assertEqual(reloaded.burnStats['ndvi']['small'].percentile(q), 0)
+
+class TestModel(unittest.TestCase):
+
+    LAYERS = ['dem', 'ndvi', 'aspect']
+    # the smallest AOI that ImageBranch's pools and convs leave anything of
+    AOI_RADIUS = 12
+
+    def test_fitKeepsLoadedPreProcessor(self):
+        from lib import model
+        data = syntheticData()
+        train = dataset.Dataset(data, {'burnA':'all'})
+        other = dataset.Dataset(data, {'burnB':'all'})
+        pp = preprocess.PreProcessor(8, self.LAYERS, self.AOI_RADIUS).fit(other)
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, 'weights.h5')
+            model.FireModel(pp).saveWeights(fname)
+            loaded = model.FireModel(preprocess.PreProcessor(8, self.LAYERS, self.AOI_RADIUS), fname)
+        saved = loaded.preProcessor.normalizer.toDict()
+        with mock.patch.object(model.FireModel, 'saveWeights'):
+            loaded.fit(train, train, epochs=1, batchSize=500)
+            self.assertEqual(loaded.preProcessor.normalizer.toDict(), saved)
+            np.testing.assert_array_equal(loaded.preProcessor.weatherMin, pp.weatherMin)
+            # unless we ask for it to be fit again
+            loaded.fit(train, train, epochs=1, batchSize=500, refit=True)
+            self.assertNotEqual(loaded.preProcessor.normalizer.toDict(), saved)
+
+    def perPointAndDense(self, **kwargs):
+        '''The predictions of a fresh model for every pixel of a day, point by point and by predictDay()'''
+        from lib import model
+        data = syntheticData()
+        ds = dataset.Dataset(data, {'burnA':{'0801':'all'}})
+        pp = preprocess.PreProcessor(8, self.LAYERS, self.AOI_RADIUS).fit(ds)
+        mod = model.FireModel(pp)
+        # make the image matter more than the default initialization does,
+        # so any misalignment of the dense branch shows up
+        kernel, bias = mod.get_layer('output').get_weights()
+        mod.get_layer('output').set_weights([np.random.RandomState(0).normal(size=kernel.shape), bias])
+        index, predictions = mod.predict(ds)
+        expected = np.empty(data.burns['burnA'].layerSize, dtype=np.float32)
+        expected[index.ys, index.xs] = predictions
+        return expected, mod.predictDay(data.getDay('burnA', '0801'), **kwargs)
+
+    def test_predictDay(self):
+        # the 30x30 day covers every offset of the dilated layers, up to 8 pixels
+        expected, dense = self.perPointAndDense()
+        np.testing.assert_allclose(dense, expected, atol=1e-5)
+
+    def test_predictDayTiled(self):
+        # tiles that don't divide the 30x30 day, and ones smaller than the 8 pixel dilation
+        for tileSize in (3, 7, 13):
+            expected, tiled = self.perPointAndDense(tileSize=tileSize, workers=2)
+            np.testing.assert_allclose(tiled, expected, atol=1e-5)
+
+    def test_tileGrid(self):
+        from lib import model
+        for h, w, tileSize in [(30, 30, 7), (5, 12, 5), (1, 1, 3)]:
+            covered = np.zeros((h, w), dtype=int)
+            for top, left, th, tw in model.tileGrid(h, w, tileSize):
+                self.assertTrue(0 < th <= tileSize and 0 < tw <= tileSize)
+                covered[top:top+th, left:left+tw] += 1
+            np.testing.assert_array_equal(covered, 1)
+
+class TestSelection(unittest.TestCase):
+
+    def test_ring(self):
+        perim = np.zeros((41, 41), dtype=np.uint8)
+        perim[20, 20] = 1
+        ys, xs = np.mgrid[:41, :41]
+        meters = np.hypot(ys-20, xs-20) * 30
+        dist = selection.distanceFromPerim(perim, pixelSize=30)
+        np.testing.assert_allclose(dist, meters, rtol=1e-3)
+        ring = selection.ringMask(dist, 100, 300)
+        np.testing.assert_array_equal(ring, (meters > 100+1e-3) & (meters <= 300+1e-3))
+        self.assertEqual(ring[20, 20], 0)
+
+    def test_cache(self):
+        selection.clear()
+        data = syntheticData(burnNames=['burn{}'.format(i) for i in range(5)])
+        days = [day for burn in data.burns.values() for day in burn.days.values()]
+        first = [selection.dayRing(day, 0, 500) for day in days]
+        # a second pass over every day doesn't recompute anything
+        self.assertTrue(all(selection.dayRing(day, 0, 500) is mask for day, mask in zip(days, first)))
+        # with room for only 3 days of distances, the least recently used are forgotten
+        oldLimit = selection.MAX_DISTANCE_BYTES
+        try:
+            selection.MAX_DISTANCE_BYTES = 3 * selection.dayDistances(days[0]).nbytes
+            selection.clear()
+            for day in days:
+                selection.dayDistances(day)
+            self.assertEqual([key[0] for key in selection._distances], ['burn3', 'burn4', 'burn4'])
+        finally:
+            selection.MAX_DISTANCE_BYTES = oldLimit
+            selection.clear()
+
 if __name__ == '__main__':
     unittest.main()